@@ -12,6 +12,7 @@
 # =============================================================================
 import requests
 import json
+import struct
 
 # Third-party imports
 import bson
@@ -44,12 +45,28 @@ data = [{"mid": "1234",
 jsreq = json.dumps(data)
 bsreq = bson_encode(data[0])
 
+def decode_iter(stream):
+    """Iterates over a concatenated sequence of BSON documents, in the manner of
+    pymongo's bson.decode_file_iter."""
+    while True:
+        size = stream.read(4)
+        if not size:
+            break
+        doc = size + stream.read(struct.unpack("<i", size)[0] - 4)
+        yield bson_decode(doc) if hasattr(bson, 'dumps') else bson_decode(doc)[0]
+
 try:
     r = requests.post("http://localhost/data", data=bsreq, headers=headers)
 except Exception as e:
-    print e
+    print(e)
 
 if r.status_code >= 400:
-    print r.status_code, r.text
+    print(r.status_code, r.text)
 else:
-    print r.status_code
+    print(r.status_code)
+
+# Stream metadata back as a sequence of BSON documents
+r = requests.get("http://localhost/metadata?bsonseq",
+                 headers={'accept': 'application/perfsonar+bson'}, stream=True)
+for record in decode_iter(r.raw):
+    print(record)
@@ -21,10 +21,9 @@ from uuid import uuid4
 
 from periscope.settings import MIME
 from periscope.settings import SCHEMAS, CONFIG_TEMPLATE
-from periscope import settings, config
-from periscope.db import DBLayer
-from periscope.utils import load_class
-from periscope.models import Manifest, ObjectDict
+from periscope import settings, config, models
+from periscope.db import DBLayer, DirectoryIndex, ManifestAccumulator, unescape_mongo
+from periscope.utils import load_class, LRUCache
 from periscope.pp_interface import PP_INTERFACE as PPI
 from periscope.handlers import DelegationHandler
 
@@ -87,13 +86,28 @@ class PeriscopeApplication(tornado.web.Application):
             await self.db[collection_name].create_index([ (timestamp_field_name, -1)],
                                                         unique = False)
 
+        # Summarize writes to uncapped collections and index their directories
+        manifest, directories = None, None
+        if not is_capped_collection:
+            if collection_name not in self._manifests:
+                self._manifests[collection_name] = ManifestAccumulator(self.db, collection_name,
+                                                                       int(self.options["register"]["limitsize"]),
+                                                                       int(self.options["register"]["threshold"]))
+            manifest = self._manifests[collection_name]
+            if collection_name not in self._directories:
+                self._directories[collection_name] = DirectoryIndex(self.db, collection_name, id_field_name)
+            directories = self._directories[collection_name]
+
         # Create Layer
         db_layer = DBLayer(self.db,
                            collection_name,
                            is_capped_collection,
                            id_field_name,
                            timestamp_field_name,
-                           history=not self.options["nohistory"])
+                           history=not self.options["nohistory"],
+                           batch_size=int(self.options["bulk"]["batchsize"]),
+                           manifest=manifest,
+                           directories=directories)
 
         return db_layer
 
@@ -141,6 +155,7 @@ class PeriscopeApplication(tornado.web.Application):
                                 name=name
             )
         )
+        self.resource_handlers[name] = handler
         return handler
 
     async def _make_getparent_handler(self,name,pattern,base_url,handler_class):
@@ -191,7 +206,7 @@ class PeriscopeApplication(tornado.web.Application):
     async def _report_to_root(self):
         manifests = []
         async for record in self.db["manifests"].find({"\\$shard": False}, {"_id": False}):
-            manifests.append(ObjectDict._from_mongo(record))
+            manifests.append(unescape_mongo(record))
 
         import time
         service = {
@@ -218,7 +233,7 @@ class PeriscopeApplication(tornado.web.Application):
             service_url = f"{lookup}/register"
             http_client = AsyncHTTPClient()
 
-            content_type = f"{MIME['PSJON']};profile={SCHEMAS['service']}"
+            content_type = f"{MIME['PSJSON']};profile={SCHEMAS['service']}"
             resp = await http_client.fetch(service_url,
                                            method="POST",
                                            body=json.dumps(service),
@@ -245,42 +260,16 @@ class PeriscopeApplication(tornado.web.Application):
         return handler
 
     async def _aggregate_manifests(self):
-        def add_key(key, value, manifest):
-            if key not in ["ts", "id", "_id", "\\$shard", "\\$collection"]:
-                try:
-                    prev = manifest["properties"][key] if key in manifest["properties"] else []
-                    if prev == "*" or value == "*" or len(value) + len(prev) > self.options["register"]["limitsize"]:
-                        prev = "*"
-                    elif len(value) > 0 and type(value[0]) == dict:
-                        prev += value
-                    else:
-                        prev = list(set(prev) | set(value))
-                    manifest["properties"][key] = prev
-                except Exception as exp:
-                    self.log.error("Bad value in shard - {exp}".format(exp = exp))
-                    
         while True:
             await asyncio.sleep(float(self.options["register"]["period"]))
-            m = self.db["manifests"]
-            collections = set()
-            for key, collection in settings.Resources.items():
-                if collection["collection_name"]:
-                    collections.add(collection["collection_name"])
-            
-            for collection in collections:
-                view = {k: False for k in ["_id", "\\$shard", "\\$collection"]}
-                manifest    = await m.find_one({ "\\$shard": False, "\\$collection": collection })
-                manifest = manifest or { "$shard": False, "$collection": collection, "properties": {} }
-
-                async for record in m.find({"\\$shard": True, "\\$collection": collection}, view):
-                    [add_key(k,v,newManifest) for k,v in record["properties"].items()]
-
-                manifest = dict(Manifest(manifest)._to_mongoiter())
-                await m.update_one({"\\$collection": collection}, manifest, upsert=True)
-
-            await m.remove({ "\\$shard": True })
+            for manifest in self._manifests.values():
+                await manifest.flush()
+
             if self.options["register"]["paths"]:
-                self._report_to_root()
+                try:
+                    await self._report_to_root()
+                except Exception as exp:
+                    self.log.error("Failed to report to root - {e}".format(e = exp))
 
     async def initialize(self):
         # Init Locals
@@ -371,8 +360,20 @@ class PeriscopeApplication(tornado.web.Application):
         self._depth = 1 if bool(self.options["lookup"]) else 0
         self._db = None
         self._ppi_classes = []
+        self._manifests = {}
+        self._directories = {}
+        self.resource_handlers = {}
+        self.query_cache = LRUCache(int(self.options["querycache"]["size"]))
         self.options['ms']['path'] = self.options['ms']['path'] or self.fullpath
 
+        # Resolve every schema before the model classes are built
+        try:
+            models.preload_schemas(models.MODEL_SCHEMAS)
+        except Exception as exp:
+            self.log.error("Failed to load schemas - {e}".format(e = exp))
+            sys.exit()
+        models.load_models()
+
         # import and initialize pre/post content processing modules
         for pp in settings.PP_MODULES:
             mod = __import__(pp[0], fromlist=pp[1])
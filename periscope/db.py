@@ -14,7 +14,7 @@
 """
 Databases related classes
 """
-import time, logging
+import asyncio, time, logging
 import functools
 from periscope import settings
 import tornado.gen
@@ -22,16 +22,72 @@ import json
 from json import JSONEncoder
 from periscope.settings import DB_AUTH
 
-from periscope.models import ObjectDict
+from periscope.utils import BulkInsertError
 
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from bson.objectid import ObjectId
-from bson.json_util import dumps
+from bson.json_util import dumps, default
 
 AuthField = DB_AUTH['auth_field']
 AuthDefault = DB_AUTH['auth_default']
 
 dumps_mongo = dumps
 
+_JSON_NATIVE = (str, int, float, type(None))
+
+def _unescape_key(key):
+    if key.startswith("\\$"):
+        key = key[1:]
+    return key.replace("$DOT$", ".")
+
+def _from_mongo_json(obj):
+    if isinstance(obj, dict):
+        return { (_unescape_key(k) if "$" in k else k): _from_mongo_json(v) for k,v in obj.items() }
+    elif isinstance(obj, (list, tuple)):
+        return [_from_mongo_json(v) for v in obj]
+    elif isinstance(obj, _JSON_NATIVE):
+        return obj
+    return default(obj)
+
+def _escape_key(key):
+    key = key.replace(".", "$DOT$")
+    return "\\" + key if key.startswith("$") else key
+
+def escape_mongo(obj):
+    """
+    Returns a copy of obj with the keys of every nested dict escaped for
+    storage in mongo, '.' becomes '$DOT$' and a leading '$' becomes '\\$'.
+    Values other than dicts and lists are shared with obj.
+    """
+    if isinstance(obj, dict):
+        # The copy is a plain dict, model values are read without wrapping them
+        return { (_escape_key(k) if isinstance(k, str) and ("." in k or k.startswith("$")) else k): escape_mongo(v)
+                 for k,v in dict.items(obj) }
+    elif isinstance(obj, list):
+        return [escape_mongo(v) for v in obj]
+    return obj
+
+def unescape_mongo(obj):
+    """Reverses escape_mongo on a document read from mongo."""
+    if isinstance(obj, dict):
+        return { (_unescape_key(k) if isinstance(k, str) and "$" in k else k): unescape_mongo(v)
+                 for k,v in obj.items() }
+    elif isinstance(obj, list):
+        return [unescape_mongo(v) for v in obj]
+    return obj
+
+def render_mongo(obj, indent=None):
+    """
+    Serializes a document read from mongo to JSON, reversing the key
+    escaping applied on insert.  BSON specific values are converted with
+    bson.json_util, everything else is left to the json encoder.  Keys are
+    unescaped on a copy because the C encoder cannot rewrite them, and an
+    encoder written in Python is slower than the copy (scripts/bench_render.py).
+    """
+    separators = (',', ': ') if indent is not None else (',', ':')
+    return json.dumps(_from_mongo_json(obj), indent=indent, separators=separators)
+
 class MongoEncoder(JSONEncoder):
     """Special JSON encoder that converts Mongo ObjectIDs to string"""
     def _iterencode(self, obj, markers=None):
@@ -52,12 +108,15 @@ class DBLayer(object):
     """
     
     def __init__(self, client, collection_name, capped=False, Id="id", \
-                 timestamp="ts", *, history=True):
+                 timestamp="ts", *, history=True, batch_size=1000, manifest=None, directories=None):
         """Intializes with a reference to the mongodb collection."""
         self.log = logging.getLogger("unis.db")
         self.Id = Id
         self.timestamp = timestamp
         self.history, self.capped = history, capped
+        self.batch_size = batch_size
+        self.manifest = manifest
+        self.directories = directories
         self._collection_name = collection_name
         self._client = client
     
@@ -66,11 +125,6 @@ class DBLayer(object):
         """Returns a reference to the default mongodb collection."""
         return self._client[self._collection_name]
     
-    @property
-    def manifest(self):
-        """Returns a reference to the manifest collection"""
-        return self._client["manifests"]
-
     async def find_one(self, query = {}, **kwargs):
         self.log.debug("find one for Collection: [" + self._collection_name + "]")
         fields = kwargs.pop("fields", {})
@@ -98,39 +152,57 @@ class DBLayer(object):
             timestamp = data.get(self.timestamp, int(time.time() * 1000000))
             data["_id"] = "%s:%s" % (res_id, timestamp) if self.history else res_id
     
-    async def insert(self, data, summarize=True, **kwargs):
-        """Inserts data to the collection."""
-        shards = []
+    async def insert(self, data, summarize=True, session=None, index=True, **kwargs):
+        """Inserts data to the collection, with index=False the directory
+        index is left for the caller to update."""
         self.log.debug("insert for Collection: [" + self._collection_name + "]")
-        if isinstance(data, list) and not self.capped:
+        data = data if isinstance(data, list) else [data]
+        if not self.capped:
             for item in data:
                 if summarize:
-                    shards.append(self._create_manifest_shard(item))
+                    self._summarize(item)
                 self._insert_id(item)
-        elif not self.capped:
-            if summarize:
-                shards.append(self._create_manifest_shard(data))
-            self._insert_id(data)
 
-        if summarize and not self.capped:
-            await self.manifest.insert_many(shards)
         if self.history:
-            results = await self.collection.insert_many(data, **kwargs)
+            results = await self.collection.insert_many(data, session=session, **kwargs)
         else:
-            results = []
+            results = await self._replace_many(data, session)
+        if index and self.directories is not None:
             for item in data:
-                rid = item.get(self.Id, str(ObjectId()))
-                results.append(await self.collection.replace_one({'id':rid},item,upsert=True))
+                self.directories.add(item)
+        return results
+
+    async def _replace_many(self, data, session=None):
+        """
+        Upserts each item over the current record with the same id.  Items
+        are sent as unordered bulk writes of batch_size items, write errors
+        are reported against the index of the item in data.
+        """
+        results, errors = [], []
+        for offset in range(0, len(data), self.batch_size):
+            ops = [ReplaceOne({self.Id: item.get(self.Id, str(ObjectId()))}, item, upsert=True)
+                   for item in data[offset:offset + self.batch_size]]
+            try:
+                results.append(await self.collection.bulk_write(ops, ordered=False, session=session))
+            except BulkWriteError as exp:
+                for error in exp.details.get("writeErrors", []):
+                    errors.append((offset + error["index"], error.get("errmsg", "")))
+        if errors:
+            raise BulkInsertError(errors)
         return results
 
     async def update(self, query, data, cert=None, replace=False, summarize=True, multi=True, **kwargs):
         """Updates data found by query in the collection."""
         self.log.debug("Update for Collection: [" + self._collection_name + "]")
+        if summarize:
+            self._summarize(data)
+        if self.directories is not None and self.Id in query:
+            if data.get("\\$status", None) == "DELETED":
+                self.directories.remove(query[self.Id])
+            elif "mode" in data:
+                self.directories.add(dict(data, **{ self.Id: query[self.Id] }))
         if not replace:
             data = { "$set": data }
-        if summarize:
-            shard = self._create_manifest_shard(data)
-            sfut = await self.manifest.insert_one(shard)
         if multi:
             results = await self.collection.update_many(query, data)
         else:
@@ -149,6 +221,13 @@ class DBLayer(object):
         """ Gets all the child folder ids recursively for a given folder
             (exnode specific)"""
         if par:
+            if self.directories is not None:
+                names = await self.directories.load()
+                while par and par not in pmap:
+                    pmap[par] = 1
+                    ids = names.get(par, None)
+                    par = ids[0] if ids else None
+                return pmap.keys()
             self.log.debug("find for Collection: [" + self._collection_name + "]")
             resource = await self.collection.find_one({"name": par, "mode": "directory"})
             pmap[par] = 1
@@ -158,17 +237,12 @@ class DBLayer(object):
         else:
             return None
         
-    def _create_manifest_shard(self, resource):
-        if "\\$collection" in resource:
-            tmpResource = resource["properties"]
-        else:
-            tmpResource = resource
-        tmpResult = {}
-        tmpResult["properties"] = self._flatten_shard(tmpResource)
-        tmpResult["$shard"] = True
-        tmpResult["$collection"] = self._collection_name
-        return dict(ObjectDict(tmpResult)._to_mongoiter())
-    
+    def _summarize(self, resource):
+        if self.manifest is not None:
+            if "\\$collection" in resource:
+                resource = resource["properties"]
+            self.manifest.add(self._flatten_shard(resource))
+
     def _flatten_shard(self, resource):
         tmpResults = {}
         for key, value in resource.items():
@@ -182,3 +256,236 @@ class DBLayer(object):
                 tmpResults[key] = [value]
                 
         return tmpResults
+
+
+class DirectoryIndex(object):
+    """Maps directory names to the ids of the directories with that name.
+
+    The map backs the folder lookups of getRecParentNames.  It is read from
+    the collection on first use and then kept current by the writes made
+    through DBLayer, directories marked deleted are dropped.
+    """
+    def __init__(self, client, collection_name, Id="id"):
+        self.Id = Id
+        self.names, self._ids = None, {}
+        self._client = client
+        self._collection_name = collection_name
+        self._loading, self._staged = None, []
+
+    async def load(self):
+        """Returns the name to ids map, reading it on first use."""
+        if self.names is None:
+            if self._loading is None:
+                self._loading = asyncio.ensure_future(self._load())
+            await self._loading
+        return self.names
+
+    async def _load(self):
+        self.names = None
+        names, query = {}, { "mode": "directory", "\\$status": { "$ne": "DELETED" } }
+        try:
+            async for record in self._client[self._collection_name].find(query, { "name": 1, self.Id: 1, "_id": 0 }):
+                if "name" in record and self.Id in record:
+                    names.setdefault(record["name"], [])
+                    if record[self.Id] not in names[record["name"]]:
+                        names[record["name"]].append(record[self.Id])
+                        self._ids.setdefault(record[self.Id], set()).add(record["name"])
+        except Exception:
+            self._loading, self._ids, self._staged = None, {}, []
+            raise
+        self.names = names
+        staged, self._staged = self._staged, []
+        for f, arg in staged:
+            f(arg)
+
+    def add(self, resource):
+        """Records a written resource, removing it if no longer a directory."""
+        if self.names is None:
+            if self._loading is not None:
+                self._staged.append((self.add, resource))
+            return
+        rid, name = resource.get(self.Id, None), resource.get("name", None)
+        if resource.get("mode", None) != "directory" or resource.get("\\$status", None) == "DELETED":
+            self.remove(rid)
+        elif rid is not None and name is not None:
+            ids = self.names.setdefault(name, [])
+            if rid not in ids:
+                ids.append(rid)
+                self._ids.setdefault(rid, set()).add(name)
+
+    def remove(self, rid):
+        """Drops every name recorded for the directory rid."""
+        if self.names is None:
+            if self._loading is not None:
+                self._staged.append((self.remove, rid))
+            return
+        for name in self._ids.pop(rid, ()):
+            ids = self.names.get(name, [])
+            if rid in ids:
+                ids.remove(rid)
+            if not ids:
+                self.names.pop(name, None)
+
+_NO_TRANSACTIONS = set()
+
+async def insert_atomic(writes):
+    """
+    Inserts the records of several collections all or nothing.  writes is a
+    list of (DBLayer, records) pairs sharing one client.  The inserts run in
+    a single transaction when the backend supports them, otherwise records
+    written before a failure are removed and the records they replaced are
+    restored.  Records are summarized and added to the directory index once
+    all of them are written.
+    """
+    log = logging.getLogger("unis.db")
+    writes = [(layer, records) for layer, records in writes if records]
+    if not writes:
+        return
+    client = getattr(writes[0][0]._client, "client", None)
+    if client is not None and id(client) not in _NO_TRANSACTIONS:
+        try:
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    for layer, records in writes:
+                        await layer.insert(records, summarize=False, session=session, index=False)
+        except OperationFailure as exp:
+            # IllegalOperation, transactions need a replica set or mongos
+            if exp.code != 20:
+                raise
+            log.warn("Transactions are not supported by the backend, falling back to compensating writes")
+            _NO_TRANSACTIONS.add(id(client))
+            await _insert_compensated(writes)
+    else:
+        await _insert_compensated(writes)
+
+    for layer, records in writes:
+        for item in records:
+            layer._summarize(item)
+            if layer.directories is not None:
+                layer.directories.add(item)
+
+def _unwritten(exp, count):
+    """Returns the indexes of the records a failed insert did not write."""
+    if isinstance(exp, BulkInsertError):
+        return { index for index, _ in exp.errors }
+    if isinstance(exp, BulkWriteError):
+        # insert_many is ordered, records after the first error are not attempted
+        first = min((e["index"] for e in exp.details.get("writeErrors", [])), default=count)
+        return set(range(first, count))
+    return set()
+
+async def _insert_compensated(writes):
+    log = logging.getLogger("unis.db")
+    done = []
+    try:
+        for layer, records in writes:
+            previous = []
+            if not layer.history:
+                ids = [r[layer.Id] for r in records if layer.Id in r]
+                previous = [r async for r in layer.collection.find({ layer.Id: { "$in": ids } })]
+            unwritten = set()
+            done.append((layer, records, previous, unwritten))
+            try:
+                await layer.insert(records, summarize=False, index=False)
+            except Exception as exp:
+                unwritten.update(_unwritten(exp, len(records)))
+                raise
+    except Exception:
+        for layer, records, previous, unwritten in reversed(done):
+            try:
+                # Records that failed, e.g. on a duplicate _id, left the stored ones in place
+                written = [r for i, r in enumerate(records) if i not in unwritten]
+                await layer.collection.delete_many({ "_id": { "$in": [r["_id"] for r in written if "_id" in r] } })
+                ids = set(r.get(layer.Id, None) for r in written)
+                previous = [item for item in previous if item.get(layer.Id, None) in ids]
+                for item in previous:
+                    layer._insert_id(item)
+                if previous:
+                    await layer.collection.insert_many(previous)
+            except Exception as exp:
+                log.error("Failed to roll back {c} - {e}".format(c = layer._collection_name, e = exp))
+        raise
+
+
+class ManifestAccumulator(object):
+    """Summarizes the resources written to a collection.
+
+    Each write is flattened into a shard that is merged into the manifest
+    in memory.  Values are kept verbatim until a key holds more than limit
+    values, after which the key collapses to "*".  The compact manifest is
+    written to the manifests collection when flush is called, or early once
+    threshold writes have been merged since the last flush.
+    """
+    SKIP = ["ts", "id", "_id"]
+
+    def __init__(self, client, collection_name, limit=10, threshold=1000):
+        self.log = logging.getLogger("unis.db")
+        self.limit, self.threshold = limit, threshold
+        self.properties, self.pending = {}, 0
+        self._client = client
+        self._collection_name = collection_name
+        self._id, self._loaded, self._flushing = str(ObjectId()), False, False
+
+    @property
+    def collection(self):
+        """Returns a reference to the manifest collection"""
+        return self._client["manifests"]
+
+    def add(self, properties):
+        """Merges a flattened shard into the manifest."""
+        for key, value in properties.items():
+            key = _unescape_key(key)
+            if key in self.SKIP:
+                continue
+            try:
+                prev = self.properties.get(key, [])
+                if prev == "*" or value == "*" or len(value) + len(prev) > self.limit:
+                    prev = "*"
+                elif len(value) > 0 and type(value[0]) == dict:
+                    prev = prev + value
+                else:
+                    prev = list(set(prev) | set(value))
+                self.properties[key] = prev
+            except Exception as exp:
+                self.log.error("Bad value in shard - {exp}".format(exp = exp))
+        self.pending += 1
+        if self.pending >= self.threshold and not self._flushing:
+            asyncio.ensure_future(self.flush())
+
+    async def _load(self):
+        """Merges the stored manifest and any shards left by older versions."""
+        query = { "\\$shard": False, "\\$collection": self._collection_name }
+        record = await self.collection.find_one(query)
+        if record:
+            self._id = record.get("id", self._id)
+            self.add(record.get("properties", {}))
+        query["\\$shard"] = True
+        async for record in self.collection.find(query):
+            self.add(record.get("properties", {}))
+        await self.collection.delete_many(query)
+        self._loaded = True
+
+    async def flush(self):
+        """Writes the manifest to the manifests collection."""
+        if self._flushing or (self._loaded and not self.pending):
+            return
+        self._flushing = True
+        try:
+            if not self._loaded:
+                await self._load()
+            pending = self.pending
+            manifest = {
+                "\\$shard": False,
+                "\\$collection": self._collection_name,
+                "id": self._id,
+                "ts": int(time.time() * 1000000),
+                "properties": { _escape_key(k): v for k,v in self.properties.items() }
+            }
+            await self.collection.replace_one({ "\\$collection": self._collection_name,
+                                                "\\$shard": False }, manifest, upsert=True)
+            # Shards added while the manifest was written stay pending
+            self.pending -= pending
+        except Exception as exp:
+            self.log.error("Failed to write manifest for {c} - {e}".format(c = self._collection_name, e = exp))
+        finally:
+            self._flushing = False
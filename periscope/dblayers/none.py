@@ -1,8 +1,11 @@
-import copy, re, time, os, pathlib, json, logging
-from collections import defaultdict
+import bisect, copy, functools, heapq, itertools, mmap, re, struct, time, os, pathlib, json, logging
+from collections import defaultdict, deque, namedtuple
 from collections.abc import MutableSequence
 from uuid import uuid4
 from threading import Thread,RLock
+import bson
+from pymongo.errors import BulkWriteError
+from periscope.utils import LRUCache
 
 class LockedList(MutableSequence):
     def __init__(self, *args):
@@ -29,56 +32,478 @@ class LockedList(MutableSequence):
         with self.lock:
             self._ls.insert(k,v)
 
+_MAGIC = b"UNISBSN1"
+_TRAILER = struct.Struct("<QQ8s")
+
+class _Mapped(object):
+    """
+    A record in a memory mapped snapshot, decoded the first time it is
+    read.  The decoded record is kept so every reader shares one dict.  The
+    map and offset are held as one value so compaction can move the record
+    to the new snapshot while other threads read it.
+    """
+    __slots__ = ("_at", "_rec")
+    def __init__(self, buf, off):
+        self._at, self._rec = (buf, off), None
+
+    def raw(self):
+        buf, off = self._at
+        n = struct.unpack_from("<i", buf, off)[0]
+        return buf[off:off + n]
+
+    def record(self):
+        if self._rec is None:
+            self._rec = bson.decode(self.raw())
+        return self._rec
+
+    def key(self):
+        """Returns the _id of the record, read without decoding it when stored first."""
+        buf, off = self._at
+        if self._rec is None and buf[off + 4:off + 9] == b"\x02_id\x00":
+            n = struct.unpack_from("<i", buf, off + 9)[0]
+            return buf[off + 13:off + 12 + n].decode("utf-8")
+        return self.record().get("_id", None)
+
+def _record(x):
+    return x.record() if isinstance(x, _Mapped) else x
+
+class MappedRecords(list):
+    """
+    Record list of a collection loaded from a binary snapshot.  Elements are
+    decoded and replaced in place as they are read.
+    """
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return MappedRecords(list.__getitem__(self, k))
+        x = list.__getitem__(self, k)
+        if isinstance(x, _Mapped):
+            x = x.record()
+            list.__setitem__(self, k, x)
+        return x
+
+    def __iter__(self):
+        for i, x in enumerate(list.__iter__(self)):
+            if isinstance(x, _Mapped):
+                mapped, x = x, x.record()
+                if i < len(self) and list.__getitem__(self, i) is mapped:
+                    list.__setitem__(self, i, x)
+            yield x
+
+def write_snapshot(path, records):
+    """
+    Writes records as a binary snapshot: the magic, each record as a BSON
+    document with its _id first, an index of record offsets and a trailer
+    holding the record count and the index offset.  Mapped records from an
+    earlier snapshot are copied from their stored bytes.  Returns the offset
+    of each record.
+    """
+    offsets = []
+    with open(path, 'wb') as f:
+        f.write(_MAGIC)
+        for x in records:
+            offsets.append(f.tell())
+            if isinstance(x, _Mapped):
+                f.write(x.raw())
+            else:
+                f.write(bson.encode(dict({ "_id": x["_id"] }, **x) if "_id" in x else x))
+        index = f.tell()
+        f.write(struct.pack("<{}Q".format(len(offsets)), *offsets))
+        f.write(_TRAILER.pack(len(offsets), index, _MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    return offsets
+
+def _map(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_snapshot(path):
+    """Maps a binary snapshot and returns its records, each decoded when first read."""
+    buf = _map(path)
+    count, index, magic = _TRAILER.unpack_from(buf, len(buf) - _TRAILER.size)
+    if magic != _MAGIC:
+        raise ValueError("Truncated snapshot {}".format(path))
+    return MappedRecords(_Mapped(buf, off) for off in struct.unpack_from("<{}Q".format(count), buf, index))
+
+_ReplaceOp = namedtuple("_ReplaceOp", ["filter", "doc", "upsert"])
+
+def _replace_args(op):
+    """
+    Returns the filter, replacement and upsert flag of a bulk replace given
+    as a (filter, replacement, upsert) tuple or a pymongo ReplaceOne.
+    ReplaceOne has no public accessors, so its values are read from the
+    attributes pymongo keeps them in.
+    """
+    if isinstance(op, tuple):
+        return op
+    try:
+        return op._filter, op._doc, op._upsert
+    except AttributeError:
+        raise TypeError("Unsupported bulk operation {!r}".format(op))
+
+class _Transaction(object):
+    def __init__(self, session):
+        self._session = session
+
+    async def __aenter__(self):
+        self._session._undo = []
+        return self
+
+    async def __aexit__(self, ty, exc, tb):
+        undo, self._session._undo = self._session._undo, None
+        if ty is not None:
+            for f in reversed(undo):
+                f()
+        return False
+
+class Session(object):
+    """
+    Mirrors a motor client session.  Writes made with the session inside
+    start_transaction record how to undo them, and are undone in reverse
+    order if the transaction block raises.
+    """
+    def __init__(self):
+        self._undo = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.end_session()
+        return False
+
+    def start_transaction(self):
+        return _Transaction(self)
+
+    def end_session(self):
+        self._undo = None
+
+    def _log(self, f):
+        if self._undo is not None:
+            self._undo.append(f)
+
+def _resolve(d, path):
+    for k in path:
+        d = d[k]
+    return d
+
+class HashIndex(object):
+    """
+    Maps each value of a field to the records holding it.  Serves equality
+    and $in predicates.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._buckets = {}
+
+    def add(self, rec):
+        try:
+            self._buckets.setdefault(_resolve(rec, self.path), {})[id(rec)] = rec
+        except (KeyError, TypeError):
+            pass
+
+    def remove(self, rec):
+        try:
+            v = _resolve(rec, self.path)
+            bucket = self._buckets[v]
+            bucket.pop(id(rec), None)
+            if not bucket:
+                del self._buckets[v]
+        except (KeyError, TypeError):
+            pass
+
+    def lookup(self, cond):
+        if isinstance(cond, dict):
+            if len(cond) != 1: return None
+            op, v = next(iter(cond.items()))
+            if op == "$eq" and not isinstance(v, (re.Pattern, dict)):
+                values = [v]
+            elif op == "$in" and isinstance(v, list):
+                values = v
+            else:
+                return None
+        elif isinstance(cond, re.Pattern):
+            return None
+        else:
+            values = [cond]
+        try:
+            result = {}
+            for v in values:
+                result.update(self._buckets.get(v, {}))
+        except TypeError:
+            return None
+        return list(result.values())
+
+class SortedIndex(object):
+    """
+    Keeps the records with a numeric value for a field ordered by that
+    value.  Serves equality and range predicates.
+    """
+    _NUMBER = (int, float)
+
+    def __init__(self, path):
+        self.path = path
+        self._keys, self._recs = [], []
+
+    def _key(self, rec):
+        try:
+            v = _resolve(rec, self.path)
+        except (KeyError, TypeError):
+            return None
+        return v if isinstance(v, self._NUMBER) and not isinstance(v, bool) else None
+
+    def add(self, rec):
+        v = self._key(rec)
+        if v is not None:
+            i = bisect.bisect_right(self._keys, v)
+            self._keys.insert(i, v)
+            self._recs.insert(i, rec)
+
+    def remove(self, rec):
+        v = self._key(rec)
+        if v is not None:
+            for i in range(bisect.bisect_left(self._keys, v), bisect.bisect_right(self._keys, v)):
+                if self._recs[i] is rec:
+                    del self._keys[i], self._recs[i]
+                    return
+
+    def lookup(self, cond):
+        lo, hi = 0, len(self._keys)
+        bounds = cond.items() if isinstance(cond, dict) else [("$eq", cond)]
+        used = False
+        for op, v in bounds:
+            if not isinstance(v, self._NUMBER) or isinstance(v, bool):
+                continue
+            if op in ("$eq", "$gte"): lo, used = max(lo, bisect.bisect_left(self._keys, v)), True
+            if op == "$gt": lo, used = max(lo, bisect.bisect_right(self._keys, v)), True
+            if op in ("$eq", "$lte"): hi, used = min(hi, bisect.bisect_right(self._keys, v)), True
+            if op == "$lt": hi, used = min(hi, bisect.bisect_left(self._keys, v)), True
+        return self._recs[lo:max(lo, hi)] if used else None
+
+_COMPARE = {
+    '$eq': lambda i: lambda x, ctx, p: ctx == p[i],
+    '$ne': lambda i: lambda x, ctx, p: ctx != p[i],
+    '$gt': lambda i: lambda x, ctx, p: ctx > p[i],
+    '$gte': lambda i: lambda x, ctx, p: ctx >= p[i],
+    '$lt': lambda i: lambda x, ctx, p: ctx < p[i],
+    '$lte': lambda i: lambda x, ctx, p: ctx <= p[i],
+}
+
+def _in(i):
+    def f(x, ctx, p):
+        values, lookup = p[i]
+        try:
+            return ctx in lookup
+        except TypeError:
+            return ctx in values
+    return f
+
+_FILTERS = LRUCache(512)
+
+def _shape(q, params):
+    """
+    Returns the structure of the filter q with each operand replaced by a
+    slot, the operands are appended to params in the order of the slots.
+    Filters differing only in their operands share a shape, and so share
+    the predicate compiled for it.
+    """
+    if not isinstance(q, dict):
+        params.append(q)
+        return "P" if isinstance(q, re.Pattern) else "V"
+    items = []
+    for k,v in q.items():
+        if k in ('$and', '$or'):
+            items.append((k, tuple(_shape(inner, params) for inner in v)))
+        elif k == '$not':
+            items.append((k, _shape(v, params)))
+        elif k == '$in':
+            try: params.append((v, frozenset(v) if isinstance(v, (list, tuple, set)) else v))
+            except TypeError: params.append((v, v))
+            items.append((k, None))
+        elif k in _COMPARE:
+            params.append(v)
+            items.append((k, None))
+        else:
+            items.append((k, _shape(v, params)))
+    return tuple(items)
+
+def _build(shape, slots):
+    """
+    Compiles a filter shape into a predicate taking the record, the value
+    under test and the operands.  slots yields the operand index of each
+    slot in the order _shape assigned them.
+    """
+    if shape == "P":
+        i = next(slots)
+        return lambda x, ctx, p: re.match(p[i], ctx)
+    if shape == "V":
+        i = next(slots)
+        return lambda x, ctx, p: ctx == p[i]
+    preds = []
+    for k,inner in shape:
+        if k in ('$and', '$or'):
+            subs = [_build(s, slots) for s in inner]
+            test = all if k == '$and' else any
+            preds.append(lambda x, ctx, p, subs=subs, test=test: test(s(x, ctx, p) for s in subs))
+        elif k == '$not':
+            sub = _build(inner, slots)
+            preds.append(lambda x, ctx, p, sub=sub: not sub(x, ctx, p))
+        elif k == '$in':
+            preds.append(_in(next(slots)))
+        elif k in _COMPARE:
+            preds.append(_COMPARE[k](next(slots)))
+        else:
+            preds.append(_field(tuple(k.split('.')), _build(inner, slots)))
+    if len(preds) == 1:
+        return preds[0]
+    def f(x, ctx, p):
+        for pred in preds:
+            if not pred(x, ctx, p):
+                return False
+        return True
+    return f
+
+def _field(path, sub):
+    def f(x, ctx, p):
+        try:
+            v = _resolve(x, path)
+        except KeyError:
+            return False
+        return sub(x, v, p)
+    return f
+
+def _conjuncts(q):
+    if isinstance(q, dict):
+        for k, v in q.items():
+            if k == "$and" and isinstance(v, list):
+                for inner in v:
+                    yield from _conjuncts(inner)
+            elif not k.startswith("$"):
+                yield k, v
+
 class Collection(object):
     def __init__(self, name):
         self._v = LockedList()
         self.name = name
+        self._indexes, self._order, self._seq = {}, {}, 0
+        self._pending = {}
+        self._journal = None
 
     @classmethod
     def load(cls, filepath, name):
         filepath = os.path.join(filepath, name)
         col = Collection(name)
+        with open(filepath, 'rb') as f:
+            if f.read(len(_MAGIC)) == _MAGIC:
+                col._v._ls = read_snapshot(filepath)
+                return col
         with col._v.lock:
             with open(filepath) as f:
                 for v in json.load(f):
                     try:
+                        v.setdefault("_id", str(uuid4()))
                         col._v.append(v)
                     except Exception:
                         logging.getLogger("unis.db").warn(f"Failed to load records for {os.path.join(filepath, col.name)}")
         return col
 
-    async def create_index(self, *args, **kwargs): pass
+    async def create_index(self, keys, **kwargs):
+        """
+        Indexes the leading field of keys.  A single ascending or descending
+        field gets a sorted index, a compound or "hashed" key a hash index.
+        Indexes are built on the first use of the collection, so records
+        mapped from a snapshot are not decoded at startup, and are kept
+        current by every write to the collection.
+        """
+        keys = [(keys, 1)] if isinstance(keys, str) else keys
+        field, direction = keys[0]
+        if field in self._indexes or field in self._pending: return
+        index = SortedIndex(field.split('.')) if len(keys) == 1 and direction in (1, -1) else HashIndex(field.split('.'))
+        self._pending[field] = index
+
+    def _build_indexes(self):
+        if not self._pending: return
+        with self._v.lock:
+            if not self._indexes:
+                for rec in self._v._ls:
+                    self._order[id(rec)], self._seq = self._seq, self._seq + 1
+            for field, index in self._pending.items():
+                for rec in self._v._ls:
+                    index.add(rec)
+                self._indexes[field] = index
+            self._pending = {}
+
+    def _index_add(self, rec, seq=None):
+        if self._indexes:
+            if seq is None:
+                seq, self._seq = self._seq, self._seq + 1
+            self._order[id(rec)] = seq
+            for index in self._indexes.values():
+                index.add(rec)
+
+    def _index_remove(self, rec):
+        if self._indexes:
+            for index in self._indexes.values():
+                index.remove(rec)
+            return self._order.pop(id(rec), None)
+
+    def _journal_write(self, old, new):
+        """Journals the replacement of the record old by new, either may be None."""
+        if self._journal is not None:
+            if old is not None and (new is None or old.get("_id") != new.get("_id")):
+                self._journal(old.get("_id"), None)
+            if new is not None:
+                self._journal(new.get("_id"), new)
+
+    def _replay(self, entries):
+        """
+        Applies journaled (key, record) entries, a record replaces the one
+        with the same _id or is appended, a record of None deletes.
+        """
+        with self._v.lock:
+            ls = self._v._ls
+            positions = { (x.key() if isinstance(x, _Mapped) else x.get("_id")): i for i, x in enumerate(list.__iter__(ls)) }
+            for key, rec in entries:
+                i = positions.get(key, None)
+                if rec is None:
+                    if i is not None:
+                        ls[i] = None
+                        del positions[key]
+                elif i is None:
+                    positions[key] = len(ls)
+                    ls.append(rec)
+                else:
+                    ls[i] = rec
+            self._v._ls = type(ls)(x for x in list.__iter__(ls) if x is not None)
+
+    def _scan(self, q):
+        """
+        Returns the records that may match q, in collection order.  The
+        smallest candidate set from an indexed predicate is used, otherwise
+        every record.
+        """
+        self._build_indexes()
+        best = None
+        if self._indexes:
+            for k, v in _conjuncts(q):
+                index = self._indexes.get(k, None)
+                records = index.lookup(v) if index is not None else None
+                if records is not None and (best is None or len(records) < len(best)):
+                    best = records
+        if best is None:
+            with self._v.lock:
+                return self._v._ls[:]
+        return sorted(best, key=lambda rec: self._order[id(rec)])
 
     def _filter(self, q):
         try: q.pop("\\$status")
         except: pass
-        def f(x):
-            g = lambda d,f: d[f[0]] if len(f) == 1 else g(d[f[0]], f[1:])
-            lop = { '$and': lambda q, ctx: all([r(v, ctx) for v in q]),
-                    '$or': lambda q, ctx: any([r(v, ctx) for v in q]),
-                    '$not': lambda q, ctx: not r(q, ctx) }
-            mop = { '$eq': lambda x,y: re.match(y,x) if isinstance(y, re.Pattern) else x == y,
-                    '$ne': lambda x,y: x != y,
-                    '$gt': lambda x,y: y > x,
-                    '$gte': lambda x,y: y >= x,
-                    '$lt': lambda x,y: y < x,
-                    '$lte': lambda x,y: y <= x,
-                    '$in': lambda x,y: y in x}
-            def r(q, ctx=None):
-                if not isinstance(q, dict): return mop["$eq"](ctx, q)
-                vals = []
-                for k,v in q.items():
-                    try: vals.append(lop[k](v, ctx))
-                    except KeyError:
-                        try: vals.append(mop[k](v, ctx))
-                        except KeyError:
-                            try:
-                                vals.append(r(v, g(x, k.split('.'))))
-                            except KeyError:
-                                return False
-                return all(vals)
-            return r(q)
-        return f
+        params = []
+        shape = _shape(q, params)
+        pred = _FILTERS.get(shape, None)
+        if pred is None:
+            pred = _FILTERS[shape] = _build(shape, iter(range(len(params))))
+        return lambda x: pred(x, None, params)
 
     def find(self, filter=None, projection=None, skip=0, limit=None, sort=None, **kwargs):
         try: _id = projection.pop("_id")
@@ -86,19 +511,19 @@ class Collection(object):
         def p(x):
             r = {}
             if not projection:
-                r = copy.deepcopy(x)
+                r = dict(x)
             elif isinstance(projection, list):
                 for k in projection:
-                    try: r[k] = copy.deepcopy(x[k])
+                    try: r[k] = x[k]
                     except KeyError: r = {}
             else:
                 is_inc = list(projection.values())[0] if projection else False
                 if not all([v == is_inc for v in projection.values()]):
                     raise ValueError("Projection may not both include and exclude values")
-                r = {} if is_inc else copy.deepcopy(x)
+                r = {} if is_inc else dict(x)
                 for k,v in projection.items():
                     try:
-                        r.__setitem__(k, copy.deepcopy(x[k])) if is_inc else r.pop(k)
+                        r.__setitem__(k, x[k]) if is_inc else r.pop(k)
                     except KeyError: pass
 
             if _id == 1:
@@ -108,13 +533,7 @@ class Collection(object):
                 except KeyError: pass
             return r
 
-        def s(ls):
-            if sort is not None:
-                for k,v in sort:
-                    ls = sorted(ls, key=lambda x: x.get(k, None), reverse=(v == -1))
-            return ls
-
-        return Cursor(self._v, self._filter(filter), p, s, skip, limit)
+        return Cursor(self._scan(filter), self._filter(filter), p, sort, skip, limit)
 
     async def find_one(self, *args, **kwargs):
         c = self.find(*args, **kwargs)
@@ -122,52 +541,135 @@ class Collection(object):
             return c.next_object()
 
     async def replace_one(self, filter, data, upsert=False):
-        for i, x in enumerate(self._v):
-            if self._filter(filter)(x):
-                self._v[1] = data
-                return data
+        self._build_indexes()
+        f = self._filter(filter)
+        with self._v.lock:
+            for i, x in enumerate(self._v._ls):
+                if f(x):
+                    if "_id" in x and "_id" not in data:
+                        data = dict(data, _id=x["_id"])
+                    self._v._ls[i] = data
+                    self._index_add(data, self._index_remove(x))
+                    self._journal_write(x, data)
+                    return data
         self._insert(data)
 
-    def _insert(self, d):
+    def _swap(self, old, new):
+        with self._v.lock:
+            for i, x in enumerate(self._v._ls):
+                if x is old:
+                    seq = self._index_remove(old)
+                    if new is None:
+                        del self._v._ls[i]
+                    else:
+                        self._v._ls[i] = new
+                        self._index_add(new, seq)
+                    self._journal_write(old, new)
+                    return
+
+    async def bulk_write(self, requests, ordered=True, session=None):
+        """
+        Applies a list of ReplaceOne operations.  Operations filtering on a
+        single equality key are matched through one pass over the collection
+        instead of a scan per operation.
+        """
+        self._build_indexes()
+        requests = [_ReplaceOp(*_replace_args(op)) for op in requests]
+        errors, matched, upserted = [], 0, 0
+        keys = {tuple(op.filter.items())[0][0] if len(op.filter) == 1 else None for op in requests}
+        key = keys.pop() if len(keys) == 1 else None
+        with self._v.lock:
+            positions = None
+            if key is not None and all(isinstance(op.filter[key], (str, int)) for op in requests):
+                positions = {}
+                for i, x in enumerate(self._v._ls):
+                    if isinstance(x.get(key, None), (str, int)):
+                        positions.setdefault(x[key], i)
+            for index, op in enumerate(requests):
+                try:
+                    if positions is not None:
+                        i = positions.get(op.filter[key], None)
+                    else:
+                        f = self._filter(op.filter)
+                        i = next((i for i, x in enumerate(self._v._ls) if f(x)), None)
+                    if i is not None:
+                        old, self._v._ls[i] = self._v._ls[i], copy.deepcopy(op.doc)
+                        if "_id" in old:
+                            self._v._ls[i].setdefault("_id", old["_id"])
+                        self._index_add(self._v._ls[i], self._index_remove(old))
+                        self._journal_write(old, self._v._ls[i])
+                        if session is not None:
+                            session._log(functools.partial(self._swap, self._v._ls[i], old))
+                        matched += 1
+                    elif op.upsert:
+                        self._insert(op.doc, session)
+                        upserted += 1
+                        if positions is not None:
+                            positions[op.filter[key]] = len(self._v._ls) - 1
+                except Exception as exp:
+                    errors.append({"index": index, "errmsg": str(exp)})
+                    if ordered: break
+        result = {"nMatched": matched, "nUpserted": upserted, "writeErrors": errors}
+        if errors:
+            raise BulkWriteError(result)
+        return result
+
+    def _insert(self, d, session=None):
         if "_id" not in d:
-            try: d["_id"] = f"{d['id']:d['ts']}"
+            try: d["_id"] = f"{d['id']}:{d['ts']}"
             except KeyError: d["_id"] = str(uuid4())
-        self._v.append(copy.deepcopy(d))
+        v = copy.deepcopy(d)
+        self._build_indexes()
+        with self._v.lock:
+            self._v.append(v)
+            self._index_add(v)
+            self._journal_write(None, v)
+        if session is not None:
+            session._log(functools.partial(self._swap, v, None))
         return d
 
-    async def insert_one(self, document): return self._insert(document)
-    async def insert_many(self, documents):
-        return [self._insert(d) for d in documents]
+    async def insert_one(self, document, session=None): return self._insert(document, session)
+    async def insert_many(self, documents, session=None):
+        return [self._insert(d, session) for d in documents]
+
+    def _update(self, v, document):
+        seq = self._index_remove(v)
+        v.update(document)
+        self._index_add(v, seq)
+        self._journal_write(v, v)
 
     async def update_many(self, query, document):
         result = []
-        for v in filter(self._filter(query), self._v):
-            if "$set" in document: document = document["$set"]
-            v.update(document)
-            result.append(v)
+        with self._v.lock:
+            for v in list(filter(self._filter(query), self._scan(query))):
+                if "$set" in document: document = document["$set"]
+                self._update(v, document)
+                result.append(v)
         return result
 
     async def find_one_and_update(self, query, document, upsert=True, **kwargs):
-        try:
-            v = next(filter(self._filter(query), self._v))
-            if "$set" in document: document = document["$set"]
-            v.update(document)
-        except StopIteration:
-            if upsert:
-                self._v.append(document)
+        with self._v.lock:
+            try:
+                v = next(filter(self._filter(query), self._scan(query)))
+                if "$set" in document: document = document["$set"]
+                self._update(v, document)
+            except StopIteration:
+                if upsert:
+                    self._insert(document)
         return [v]
 
     async def delete_many(self, query):
-        todo,result = [], []
-        f = self._filter(query)
-        for i, v in enumerate(self._v):
-            if f(v): todo.append(i)
-        for idx in reversed(todo):
-            result.append(self._v.pop(idx))
-        return result
+        with self._v.lock:
+            todo = { id(v): v for v in filter(self._filter(query), self._scan(query)) }
+            if todo:
+                self._v._ls = [v for v in self._v._ls if id(v) not in todo]
+                for v in todo.values():
+                    self._index_remove(v)
+                    self._journal_write(v, None)
+        return list(reversed(todo.values()))
 
     async def count_documents(self, query, skip=0, limit=None):
-        v = list(filter(self._filter(query), self._v))
+        v = list(filter(self._filter(query), self._scan(query)))
         return max(0, min(len(v) - skip, limit if limit is not None else len(v)))
 
 
@@ -175,15 +677,47 @@ class CappedCollection(Collection):
     def __init__(self, name, size=0):
         super().__init__(name)
 
+class _Descending(object):
+    __slots__ = ("v",)
+    def __init__(self, v):
+        self.v = v
+    def __eq__(self, other):
+        return self.v == other.v
+    def __lt__(self, other):
+        return other.v < self.v
+
+def _sort_key(sort):
+    """
+    Returns the key ordering records as the sort keys applied one after the
+    other would, so the last key in sort is the most significant.
+    """
+    keys = [(k, v == -1) for k,v in reversed(sort)]
+    return lambda x: tuple(_Descending(x.get(k, None)) if desc else x.get(k, None) for k,desc in keys)
+
 class Cursor(object):
+    """
+    Iterates the matching records lazily.  The filter is applied as records
+    are consumed, a sort with a limit keeps only the first skip + limit
+    records in a heap.  Records are projected when they are returned, as
+    shallow copies sharing nested values with the collection, which must
+    not be modified.
+    """
+    _END = object()
+
     def __init__(self, c, f, proj, sort, skip, limit):
-        self._v = [proj(v) for v in sort(c) if f(v)]
-        self.head = skip
-        self.tail = len(self._v) if not limit else skip + limit
+        records = filter(f, c)
+        if sort:
+            if limit:
+                records = heapq.nsmallest(skip + limit, records, key=_sort_key(sort))
+            else:
+                records = sorted(records, key=_sort_key(sort))
+        self._proj = proj
+        self._it = itertools.islice(records, skip, skip + limit if limit else None)
+        self._next = next(self._it, Cursor._END)
 
     @property
     def alive(self):
-        return self.head < self.tail
+        return self._next is not Cursor._END
 
     @property
     def fetch_next(self):
@@ -192,8 +726,10 @@ class Cursor(object):
         return _done()
 
     def next_object(self):
-        self.head += 1
-        return self._v[self.head-1]
+        if not self.alive:
+            raise StopIteration
+        v, self._next = self._next, next(self._it, Cursor._END)
+        return self._proj(v)
 
     def __aiter__(self):
         return self
@@ -220,46 +756,151 @@ class Database(object):
 
     def __init__(self, *args, **kwargs):
         self._cols = {}
+        self.client = None
+        self.name = None
 
+    def _attach(self, col):
+        if self.client is not None and self.client._journal is not None:
+            col._journal = functools.partial(self.client._journal, self.name, col.name)
+        return col
 
     async def create_collection(self, name, size=0, capped=False, **kwargs):
-        self._cols[name] = CappedCollection(name, size) if capped else Collection(name)
+        if name not in self._cols:
+            self._cols[name] = self._attach(CappedCollection(name, size) if capped else Collection(name))
 
     def __getitem__(self, k):
         if k not in self._cols:
-            self._cols[k] = Collection(k)
+            self._cols[k] = self._attach(Collection(k))
         return self._cols[k]
 
 class Client(object):
-    def __init__(self, *args, snapshot=None, interval=30, **kwargs):
+    """
+    In memory client.  With a snapshot path every write is appended to a
+    journal in that directory, synced to disk every sync milliseconds.
+    Every interval seconds the collections are compacted into snapshot
+    files, written as JSON or with format "bson" as memory mapped binary
+    snapshots, and the journal is truncated.  On start the snapshot is
+    loaded and the journal replayed over it.
+    """
+    def __init__(self, *args, snapshot=None, interval=30, sync=100, format="json", **kwargs):
         self._args, self._kwargs, self._dbs = args, kwargs, {}
+        self._format = format
+        self._journal, self._pending = None, deque()
 
         if snapshot is not None:
             self._load_db(snapshot)
-            t = Thread(target=self._snap, kwargs={'p': snapshot, 's':int(interval)}, daemon=True)
+            self._journal = self._append
+            for db in self._dbs.values():
+                for c in db._cols.values():
+                    db._attach(c)
+            t = Thread(target=self._sync, kwargs={'p': snapshot, 's': int(interval), 'w': int(sync) / 1000}, daemon=True)
             t.start()
 
-    def _snap(self, p, s):
+    def _append(self, db, col, key, rec):
+        self._pending.append(json.dumps({"d": db, "c": col, "k": key, "v": rec}, default=str) + "\n")
+
+    def _sync(self, p, s, w):
         log = logging.getLogger("unis.db")
+        journal = open(os.path.join(p, "journal"), 'a')
+        last, dirty = time.time(), False
         while True:
-            time.sleep(s)
-            log.debug("--Snapshot--")
-            for n,db in self._dbs.items():
-                _p = os.path.join(p, n)
-                pathlib.Path(_p).mkdir(parents=True, exist_ok=True)
-                for k,c in db._cols.items():
+            time.sleep(w)
+            try:
+                dirty |= self._flush(journal)
+                if dirty and time.time() - last >= s:
+                    log.debug("--Snapshot--")
+                    self._compact(p)
+                    journal.truncate(0)
+                    os.fsync(journal.fileno())
+                    last, dirty = time.time(), False
+                    log.debug("============")
+            except Exception as exp:
+                log.error("Failed to write snapshot - {e}".format(e = exp))
+
+    def _flush(self, journal):
+        if not self._pending:
+            return False
+        while self._pending:
+            journal.write(self._pending.popleft())
+        journal.flush()
+        os.fsync(journal.fileno())
+        return True
+
+    def _compact(self, p):
+        """
+        Writes each collection to its snapshot file.  Records are copied
+        under the collection lock, files are written after it is released.
+        The journal is synced first, so it only holds changes the snapshot
+        includes and replaying it over the snapshot is harmless.
+        """
+        for n,db in list(self._dbs.items()):
+            _p = os.path.join(p, n)
+            pathlib.Path(_p).mkdir(parents=True, exist_ok=True)
+            for k,c in list(db._cols.items()):
+                tmp = os.path.join(p, ".compact")
+                if self._format == "bson":
                     with c._v.lock:
-                        with open(os.path.join(_p, k), 'w') as f:
-                            json.dump(c._v._ls, f)
-            log.debug("============")
+                        records = [x if isinstance(x, _Mapped) and x._rec is None else dict(_record(x))
+                                   for x in list.__iter__(c._v._ls)]
+                    offsets = write_snapshot(tmp, records)
+                else:
+                    with c._v.lock:
+                        records = [dict(x) for x in c._v._ls]
+                    with open(tmp, 'w') as f:
+                        json.dump(records, f, default=str)
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp, os.path.join(_p, k))
+                if self._format == "bson":
+                    self._remap(c, os.path.join(_p, k), records, offsets)
+
+    def _remap(self, c, path, records, offsets):
+        """
+        Moves the records of c still mapped from the replaced snapshot to the
+        one at path, where records were written at offsets.  Records decoded
+        in the meantime are stored as dicts.  The old map is closed when the
+        last reference to it is released, which lets the replaced file go.
+        """
+        moved = { id(x): off for x, off in zip(records, offsets) if isinstance(x, _Mapped) }
+        buf = _map(path) if moved else None
+        with c._v.lock:
+            ls = c._v._ls
+            for i, x in enumerate(list.__iter__(ls)):
+                if isinstance(x, _Mapped):
+                    if x._rec is None and id(x) in moved:
+                        x._at = (buf, moved[id(x)])
+                    else:
+                        list.__setitem__(ls, i, x.record())
 
     def _load_db(self, filepath):
         pathlib.Path(filepath).mkdir(parents=True, exist_ok=True)
         dbs = next(os.walk(filepath))[1]
         for p in dbs:
             self._dbs[p] = Database.load(filepath, p, *self._args, **self._kwargs)
+            self._dbs[p].client = self
+            self._dbs[p].name = p
+
+        entries = defaultdict(list)
+        try:
+            with open(os.path.join(filepath, "journal")) as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        logging.getLogger("unis.db").warn("Discarding incomplete journal entry")
+                        break
+                    entries[(e["d"], e["c"])].append((e["k"], e["v"]))
+        except FileNotFoundError:
+            pass
+        for (db, col), ls in entries.items():
+            self[db][col]._replay(ls)
+
+    async def start_session(self):
+        return Session()
 
     def __getitem__(self, k):
         if k not in self._dbs:
             self._dbs[k] = Database(*self._args, **self._kwargs)
+            self._dbs[k].client = self
+            self._dbs[k].name = k
         return self._dbs[k]
@@ -15,6 +15,7 @@
 import tornado.web
 import json
 
+from periscope.handlers.subscriptionmanager import GetManager
 from periscope.settings import MIME
 
 class AboutHandler(tornado.web.RequestHandler):
@@ -25,7 +26,9 @@ class AboutHandler(tornado.web.RequestHandler):
         about = {
             "uid": str(self.application.options["uuid"]),
             "haschild": self.application.options["lookup"],
-            "depth": self.application._depth
+            "depth": self.application._depth,
+            "querycache": self.application.query_cache.stats(),
+            "subscribers": GetManager().stats()
         }
         self.set_header("Content-Type", MIME["JSON"])
         self.write(json.dumps(about, indent=4))
@@ -12,21 +12,24 @@
 # =============================================================================
 #!/usr/bin/env python
 
-import asyncio, json, jsonpointer
+import asyncio, json, jsonpointer, traceback
 import tornado.web
 from jsonpath import jsonpath
-from tornado.httpclient import AsyncHTTPClient
 
-import periscope.settings as settings
 from periscope.settings import MIME
-from periscope.handlers.networkresourcehandler import NetworkResourceHandler
-from periscope.db import dumps_mongo
-from periscope.models import NetworkResource
-from periscope.models import HyperLink
-from periscope.models import Topology
+from periscope.handlers.networkresourcehandler import NetworkResourceHandler, post_metadata, pre_post, insert_resources
+from periscope.db import escape_mongo, insert_atomic
+from periscope import models
 from periscope.models import schemaLoader
 import periscope.utils as utils
 
+def _plain(value):
+    if isinstance(value, dict):
+        return { k: _plain(v) for k, v in value.items() }
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
 class CollectionHandler(NetworkResourceHandler):
     def initialize(self, collections, *args, **kwargs):
         self._collections = collections
@@ -34,6 +37,73 @@ class CollectionHandler(NetworkResourceHandler):
         self._models_index = {}
         self._dblayers_index = {}
         self._cache = {}
+        self._bulk = None
+
+    @tornado.web.removeslash
+    async def post(self, res_id=None):
+        if self.get_argument("bulk", None) == "true":
+            await self._post_bulk(res_id)
+        else:
+            await super(CollectionHandler, self).post(res_id)
+
+    async def _post_bulk(self, res_id=None):
+        """
+        Creates the resources and every embedded child all or nothing.  The
+        whole document graph is processed and validated before anything is
+        written, the records are then inserted with one bulk write per
+        collection and published once all of them are stored.
+        """
+        try:
+            self._validate_request(res_id)
+        except ValueError as exp:
+            message = "Validation Error - {exp}".format(exp = exp)
+            self.send_error(400, message = message)
+            self.log.error(message)
+            return
+
+        try:
+            resources = self._get_documents()
+        except ValueError as exp:
+            self.send_error(400, message = exp)
+            self.log.error("%s" % exp)
+            return
+
+        if not isinstance(resources, list):
+            resources = [resources]
+
+        self._bulk = { "validate": self.get_argument("validate", None) != 'false', "writes": {} }
+        try:
+            for index in range(len(resources)):
+                tmpResource = await self._process_resource(resources[index], res_id, self._bulk["validate"])
+                resources[index] = escape_mongo(tmpResource)
+        except Exception as exp:
+            message="Not valid body - {exp}".format(exp = exp)
+            traceback.print_tb(exp.__traceback__)
+            self.send_error(400, message = message)
+            self.log.error(message)
+            return
+
+        writes = self._bulk["writes"]
+        writes.setdefault(self._collection_name, (self.dblayer, []))[1].extend(resources)
+        try:
+            await insert_atomic(list(writes.values()))
+        except Exception as exp:
+            message = "Could not process the POST request - {exp}".format(exp = exp)
+            traceback.print_tb(exp.__traceback__)
+            self.send_error(409, message = message)
+            self.log.error(message)
+            return
+
+        for collection, (_, records) in writes.items():
+            self._subscriptions.publish(records, collection, { "action": "POST" })
+
+        await self._post_return(resources)
+
+        accept = self.accept_content_type
+        self.set_header("Content-Type", accept + \
+                        " ;profile="+ self.schemas_single[accept])
+        self.set_status(201)
+        self.finish()
 
     async def _put_resource(self, resource):
         try:
@@ -51,9 +121,7 @@ class CollectionHandler(NetworkResourceHandler):
         complete_links = (self.get_argument("complete_links", None) != 'false')
         
         
-        ppi_classes = getattr(self.application, '_ppi_classes', [])
-        for pp in ppi_classes:
-            pp.pre_post(tmpResource, self.application, self.request)
+        pre_post(tmpResource, self.application, self.request, self)
 
         if complete_links:
             if self._complete_href_links(resource, resource) < 0:
@@ -63,40 +131,68 @@ class CollectionHandler(NetworkResourceHandler):
         for values in links:
             tmpResource[values["collection"]] = values["hrefs"]
 
+        if self._bulk is not None and run_validate:
+            tmpResource._validate()
+
         return tmpResource
 
     async def _create_child(self, key, resource):
-        http_client = AsyncHTTPClient()
-        url = "{protocol}://{host}{path}?validate=false&complete_links=false"
         links = []
         query = []
         for r in resource[key]:
-            links.append(r) if "rel" in r and "href" in r else query.append(r)
+            links.append(r) if "rel" in r and "href" in r else query.append(_plain(r))
         if query:
-            response = await tornado.gen.Task(
-                http_client.fetch,
-                url.format(protocol = self.request.protocol, host = self.request.host, path = self.reverse_url(key)),
-                method          = "POST",
-                body            = dumps_mongo(query),
-                request_timeout = 180,
-                validate_cert   = False,
-                client_cert     = settings.CLIENT_SSL_OPTIONS['certfile'],
-                client_key      = settings.CLIENT_SSL_OPTIONS['keyfile'],
-                headers         = { "Cache-Control": "no-cache",
-                                    "Content-Type": MIME["PSJSON"],
-                                    "connection": "close" }
-            )
-            if response.code >= 400:
-                raise Exception("Could not add child resource")
-
-            response = json.loads(response.body)
-            if not isinstance(response, list):
-                links.append({ "href": response["selfRef"], "rel": "full" })
+            spec = self._child_spec(key)
+            validate = self._bulk is not None and self._bulk["validate"]
+            for index in range(len(query)):
+                tmpResource = await self._process_child(key, spec, query[index], validate)
+                query[index] = escape_mongo(tmpResource)
+            if self._bulk is None:
+                await insert_resources(spec, query)
             else:
-                for r in response:
-                    links.append({ "href": r["selfRef"], "rel": "full" })
+                self._bulk["writes"].setdefault(spec["collection_name"], (spec["dblayer"], []))[1].extend(query)
+
+            for r in query:
+                links.append({ "href": r["selfRef"], "rel": "full" })
 
         return { "collection": key, "hrefs": links }
+
+    def _child_spec(self, key):
+        """
+        Returns the settings the child collection key was registered with.
+        Embedded resources are prepared and stored with the shared POST
+        helpers rather than the child's handler, so collections whose handler
+        overrides those steps cannot be embedded.
+        """
+        urlspec = self.application.resource_handlers[key]
+        for name in ("_add_post_metadata", "_process_resource", "_insert"):
+            if getattr(urlspec.handler_class, name) not in (getattr(NetworkResourceHandler, name),
+                                                            getattr(CollectionHandler, name)):
+                raise ValueError("{} resources cannot be embedded, its handler overrides {}".format(key, name))
+        return urlspec.kwargs
+
+    async def _process_child(self, key, spec, resource, run_validate):
+        """
+        Prepares an embedded resource for the child collection key with the
+        same helpers a POST to that collection uses.  PPI hooks are called
+        with the client's request and this handler, since the child is created
+        on that client's behalf.  Resources embedded in the child are created
+        in turn.
+        """
+        tmpResource = spec["model_class"](resource, schemas_loader = schemaLoader)
+        url = "{}://{}{}".format(self.request.protocol, self.request.host, self.reverse_url(key))
+        post_metadata(tmpResource, url, spec)
+        pre_post(tmpResource, self.application, self.request, self)
+
+        collections = spec.get("collections", {})
+        links = await asyncio.gather(*[self._create_child(k, tmpResource) for k in collections.keys() if k in tmpResource])
+        for values in links:
+            tmpResource[values["collection"]] = values["hrefs"]
+
+        if run_validate:
+            tmpResource._validate()
+
+        return tmpResource
     
         
     def set_self_ref(self, resource):
@@ -115,7 +211,7 @@ class CollectionHandler(NetworkResourceHandler):
             
     def _complete_href_links(self, parent_collection, current):
         """Resolves self hyperlinks (JSONPath and JSONPointers."""
-        if isinstance(current, HyperLink) or \
+        if isinstance(current, models.HyperLink) or \
            (isinstance(current, dict) and "href" in current):
             if isinstance(current["href"], (bytes, str)):
                 resource = None
@@ -150,7 +246,7 @@ class CollectionHandler(NetworkResourceHandler):
         
         for key in keys:
             value = current[key]
-            if isinstance(value, (NetworkResource, Topology)) and \
+            if isinstance(value, (models.NetworkResource, models.Topology)) and \
                 "selfRef" not in value:
                 ret = self.set_self_ref(value)
                 if ret < 0:
@@ -19,7 +19,7 @@ import tornado.web
 from urllib.parse import urlparse,urlunparse
 
 import periscope.settings as settings
-from periscope.db import dumps_mongo, DBLayer
+from periscope.db import render_mongo, unescape_mongo, DBLayer
 from periscope.settings import MIME
 from periscope.handlers.networkresourcehandler import NetworkResourceHandler
 
@@ -62,7 +62,7 @@ class DataHandler(NetworkResourceHandler):
     async def _return_resources(self, mid, query):
         resp = []
         async for record in DBLayer(self.application.db, mid, True).find(query):
-            resp.append(ObjectDict._from_mongo(record))
+            resp.append(unescape_mongo(record))
 
         if len(resp) == 1:
             location = self.request.full_url().split('?')[0]
@@ -101,21 +101,24 @@ class DataHandler(NetworkResourceHandler):
         # we could have an SSE endpoint that implemented a hanging GET, allowing more data
         # over the HTTP connection as it arrived
         query = options.pop("query")
-        count = await DBLayer(self.application.db, res_id, True).count(query, **options)
+        dblayer = DBLayer(self.application.db, res_id, True)
+        count = await dblayer.count(query, **options) if parsed["exact_count"] else None
 
-        if not count:
+        written = 0
+        async for record in dblayer.find(query, **options):
+            record = render_mongo(record, indent=None if parsed["compact"] else 2)
+            if not await self._stream(('[\n' if not written else ',\n') + record, count):
+                return
+            written += 1
+
+        if not written:
             self.write('[]')
             return
-
-        first = True
-        async for record in DBLayer(self.application.db, res_id, True).find(query):
-            self.write('[\n' if first else ',\n')
-            first = False
-            self.write(dumps_mongo(record, indent=2).replace('\\\\$', '$').replace('$DOT$', '.'))
-        self.write('\n]')
+        await self._stream('\n]', count, final=True)
         
-        await self._add_response_headers(count)
-        self.set_status(200)
+        if not self._flushed:
+            await self._add_response_headers(written if count is None else count)
+            self.set_status(200)
         self.finish()
 
     def trim_published_resource(self, resource, fields):
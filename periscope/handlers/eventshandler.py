@@ -47,12 +47,13 @@ class EventsHandler(NetworkResourceHandler):
             else:
                 raise ValueError("event collection exists already")
             
-    async def _find(self, **options):
+    async def _find(self, exact_count=False, **options):
         options["query"].pop("\\$status", None)
+        count = await self.dblayer.count(**options) if exact_count else None
         if not options["query"]:
-            return await self.dblayer.count(**options), self.dblayer.find()
+            return count, self.dblayer.find()
         elif self.Id in options["query"] or "$or" in options["query"]:
-            return await self.dblayer.count(**options), self.dblayer.find(**options)
+            return count, self.dblayer.find(**options)
         else:
             self._query = options["query"]
             return None, None
@@ -64,7 +65,8 @@ class EventsHandler(NetworkResourceHandler):
 
         return count
 
-    async def _write_get(self, cursor, is_list = False, inline=False, unique=False, count=0):
+    async def _write_get(self, cursor, is_list = False, inline=False, unique=False, count=0,
+                         compact=False, bsonseq=False):
         response = []
         if cursor:
             async for resource in cursor:
@@ -96,7 +98,7 @@ class EventsHandler(NetworkResourceHandler):
         if self.accept_content_type == MIME["PSBSON"]:
             json_response = bson_encode(response)
         else:
-            json_response = dumps_mongo(response, indent=2)
+            json_response = dumps_mongo(response, indent=None if compact else 2)
         self.write(json_response)
         return count
         
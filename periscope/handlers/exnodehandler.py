@@ -15,14 +15,9 @@
 import json
 import functools
 from tornado.ioloop import IOLoop
-from tornado.httpclient import AsyncHTTPClient
 import tornado.web
-import tornado.gen
 
-import periscope.settings as settings
-from periscope.settings import MIME
 from .collectionhandler import CollectionHandler
-from periscope.db import dumps_mongo
 
 class FolderHandler(tornado.web.RequestHandler):
     def initialize(self, dblayer,base_url):
@@ -30,42 +25,32 @@ class FolderHandler(tornado.web.RequestHandler):
         
     async def get(self,res_id=None):
         par = self.get_argument("parent",default=None)
-        val = await self._dblayer.getRecParentNames(par)
-        self.log.info("Getting recurrsive folder ids for: [" + self._dblayer._collection_name + "]" + " with Parent " + par)
+        val = await self._dblayer.getRecParentNames(par, {})
+        self.application.log.info("Getting recurrsive folder ids for: [" + self._dblayer._collection_name + "]" + " with Parent " + str(par))
         if (val == None):
             self.write(json.dumps([]))
         else:
-            self.write(json.dumps(val))
+            self.write(json.dumps(list(val)))
         self.set_header('Content-Type', 'application/json')
         self.finish()
 
 class ExnodeHandler(CollectionHandler):
-    async def _post_get(self, resource, inline=False):
-        if not inline or resource.get("mode", None) == "directory":
-            return resource
+    async def _post_get_page(self, resources, inline=False):
+        files = [r for r in resources if inline and r.get("mode", None) != "directory"]
+        if not files:
+            return resources
 
         try:
-            extents = await self._get_extents(resource["selfRef"])
-            resource["extents"] = json.loads(extents.body)
+            extents = {}
+            for resource in files:
+                resource["extents"] = extents.setdefault(resource["selfRef"], [])
+            dblayer = self.application.resource_handlers["extents"].kwargs["dblayer"]
+            query = { "parent.href": { "$in": list(extents.keys()) }, "\\$status": { "$ne": "DELETED" } }
+            async for extent in dblayer.find(query, sort = [(self.timestamp, -1)]):
+                parent = extent.get("parent", {}).get("href", None)
+                if parent in extents:
+                    extents[parent].append(extent)
         except Exception as exp:
             raise Exception("Could not load extent data - {exp}".format(exp = exp))
-        
-        return resource
-    
-    def _get_extents(self, parent):
-        http_client = AsyncHTTPClient()
-        url = "{protocol}://{host}/extents?parent.href={parent}"
-        return tornado.gen.Task(
-            http_client.fetch,
-            url.format(protocol = self.request.protocol,
-                       host     = self.request.host,
-                       parent   = parent),
-            method = "GET",
-            request_timeout = 180,
-            validate_cert = False,
-            client_cert     = settings.CLIENT_SSL_OPTIONS['certfile'],
-            client_key      = settings.CLIENT_SSL_OPTIONS['keyfile'],
-            headers         = { "Cache-Control": "no-cache",
-                                "Content-Type": MIME["PSJSON"],
-                                "connection": "close" }
-        )
+
+        return resources
@@ -14,14 +14,13 @@
 
 import copy, re
 import bson, json
-import urllib3.request
-from urllib.parse import urlparse
+from urllib.parse import urlparse, unquote
 import traceback
 from tornado.httpclient import HTTPError
+from tornado.iostream import StreamClosedError
 import tornado.web
 
-from periscope.db import dumps_mongo
-from periscope.models import ObjectDict
+from periscope.db import escape_mongo, render_mongo
 from periscope.settings import MIME
 from periscope.handlers import subscriptionmanager
 from periscope.handlers.ssehandler import SSEHandler
@@ -40,14 +39,42 @@ else:
 
 def decode(str):
     while True:
-        dec = urllib3.request.unquote(str)
+        dec = unquote(str)
         if dec == str:
             break
         str = dec
     return dec
 
-def _render(resource):
-    return dumps_mongo(resource, indent=2).replace('\\\\$', '$').replace('$DOT$', '.')
+class _RecFind(object):
+    """Placeholder for a recfind= lookup, resolved each time a plan is bound."""
+    def __init__(self, parent):
+        self.parent = parent
+
+def _render(resource, compact=False):
+    return render_mongo(resource, indent=None if compact else 2)
+
+# The helpers below prepare and store POSTed resources from the settings a
+# collection was registered with (the handler kwargs), they are shared by
+# NetworkResourceHandler.post and the creation of embedded child resources.
+def post_metadata(resource, url, spec):
+    """Sets the selfRef and default $schema of a resource POSTed to url."""
+    uri = urlparse(url)
+    resource["selfRef"] = "{scheme}://{netloc}/{col}/{uid}".format(scheme=uri.scheme,
+                                                                   netloc=uri.netloc,
+                                                                   col=uri.path.split("/")[1],
+                                                                   uid = resource[spec["Id"]])
+    resource["$schema"] = resource.get("$schema", spec["schemas_single"][MIME['PSJSON']])
+    return resource
+
+def pre_post(resource, application, request, handler):
+    """Runs the pre_post hooks of the loaded PPI modules on a resource."""
+    for pp in getattr(application, '_ppi_classes', []):
+        pp.pre_post(resource, application, request, Handler = handler)
+
+async def insert_resources(spec, resources):
+    """Stores resources in the collection of spec and publishes them to its subscribers."""
+    await spec["dblayer"].insert(resources)
+    subscriptionmanager.GetManager().publish(resources, spec["collection_name"], { "action": "POST" })
 
 class NetworkResourceHandler(SSEHandler):
     """Generic Network resources handler"""
@@ -116,6 +143,10 @@ class NetworkResourceHandler(SSEHandler):
         self._model_class = model_class
         self._subscriptions = subscriptionmanager.GetManager()
         self._collection_name = collection_name
+        self._spec = { "Id": Id, "dblayer": dblayer, "schemas_single": schemas_single,
+                       "collection_name": collection_name }
+        self._chunk, self._chunk_size, self._pending = [], 0, 0
+        self._flushed, self._client_closed = False, False
         
         if self.schemas_single is not None and \
             MIME["JSON"] not in self.schemas_single and \
@@ -244,7 +275,23 @@ class NetworkResourceHandler(SSEHandler):
         self.set_header('Access-Control-Allow-Headers', 'x-requested-with')
 
     async def _parse_get_arguments(self):
-        """Parses the HTTP GET areguments given by the user."""
+        """
+        Parses the HTTP GET areguments given by the user.
+
+        Compiled query plans are cached by the normalized query string,
+        only recfind lookups and PPI clauses are bound per request.
+        """
+        cache = getattr(self.application, "query_cache", None)
+        key = (self.timestamp, tuple(sorted((k, tuple(v)) for k, v in self.request.arguments.items())))
+        plan = cache.get(key) if cache is not None else None
+        if plan is None:
+            plan = self._compile_get_arguments()
+            if cache is not None:
+                cache[key] = plan
+        return await self._bind_get_arguments(plan)
+
+    def _compile_get_arguments(self):
+        """Compiles the HTTP GET arguments into a reusable query plan."""
         def convert_value_type(key, value, val_type):
             if val_type == "integer":
                 try:
@@ -274,27 +321,28 @@ class NetworkResourceHandler(SSEHandler):
             raise HTTPError(400,
                         message="Unkown value type '%s' for '%s'." % (val_type, key))
 
-        async def process_value(key, value):
+        def process_value(key, value):
             val = None
             in_split = value.split(",")
             if len(in_split) > 1:
-                return await process_in_query(key, in_split)[key]
+                return process_in_query(key, in_split)[key]
             operators = ["lt", "lte", "gt", "gte", "not", "eq", "null", "recfind", "reg"]
             for op in operators:
                 if value.startswith(op + "="):
+                    operand = value[len(op) + 1:]
                     if op == "not":
-                        tmpVal = re.compile("^"+(await process_value(key, value.lstrip(op + "="))) + "$", re.IGNORECASE)
+                        tmpVal = re.compile("^"+process_value(key, operand) + "$", re.IGNORECASE)
                     elif op == "eq":
-                        return float(await process_value(key, value.lstrip(op+"=")))
+                        return float(process_value(key, operand))
                     elif op == "null":
                         return None
                     elif op == "reg":
-                        return re.compile((await process_value(key, value.lstrip(op + "="))), re.IGNORECASE)
+                        return re.compile(process_value(key, operand), re.IGNORECASE)
                     elif op == "recfind":
-                        tmpVal = await process_value(key, value.lstrip(op + "="))
-                        return {"$in": await self.dblayer.getRecParentNames(tmpVal,{})}
+                        plan["recfind"] = True
+                        return _RecFind(process_value(key, operand))
                     else:
-                        tmpVal = await process_value(key, value.lstrip(op + "="))
+                        tmpVal = process_value(key, operand)
                         if op in ["lt", "lte", "gt", "gte"]:
                             tmpVal = float(tmpVal)
 
@@ -315,32 +363,32 @@ class NetworkResourceHandler(SSEHandler):
                 or_q.append({ key: None })
             return  { "$or": or_q }
 
-        async def process_in_query(key, values):
-            return {key: {"$in": [await process_value(key,v) for v in values]}}
+        def process_in_query(key, values):
+            return {key: {"$in": [process_value(key,v) for v in values]}}
 
-        async def process_or_query(key, values):
-            async def f(k,v): return {k: await process_value(k,v)}
-            or_q = {key: await process_value(key, values.pop(0))} if key else []
+        def process_or_query(key, values):
+            or_q = [{key: process_value(key, values.pop(0))}] if key else []
             try:
-                or_q += [f(*v.split('=', 1)) for v in values]
-            except IndexError:
+                or_q += [{k: process_value(k, v)} for k,v in (v.split('=', 1) for v in values)]
+            except ValueError:
                 raise HTTPError(400, message="Not valid OR query.")
             return {"$or": or_q}
 
-        async def process_and_query(key, values):
+        def process_and_query(key, values):
             and_q = []
             for val in values:
                 split_or = val.split("|")
                 if len(split_or) > 1:
-                    and_q.append((await process_or_query(key, split_or)))
+                    and_q.append(process_or_query(key, split_or))
                 else:
                     split = val.split(",")
                     if len(split) == 1:
-                        and_q.append({key: await process_value(key, split[0])})
+                        and_q.append({key: process_value(key, split[0])})
                     else:
-                        and_q.append(await process_in_query(key, split))
+                        and_q.append(process_in_query(key, split))
             return {"$and": and_q}
 
+        plan = {"recfind": False}
         query = copy.copy(self.request.arguments)
         for k in query.keys():
             query[k] = list(map(lambda x: x.decode() if type(x) == bytes else x, query[k]))
@@ -391,16 +439,19 @@ class NetworkResourceHandler(SSEHandler):
             sort = list(sortDict.items())
 
         unique = query.pop('unique', ['false']) != ['false']
+        exact_count = query.pop('exact_count', ['false']) != ['false']
+        compact = query.pop('compact', ['false']) != ['false']
+        bsonseq = query.pop('bsonseq', ['false']) != ['false']
         query_ret = []
         for arg in query:
             if isinstance(query[arg], list) and len(query[arg]) > 1:
-                and_q = await process_and_query(arg, query[arg])
+                and_q = process_and_query(arg, query[arg])
                 query_ret.append(and_q)
                 continue
             query[arg] = ",".join(query[arg])
             if query[arg].startswith("reg="):
                 param = decode(query[arg][4:])
-                val = re.compile((await process_value(arg,param)), re.IGNORECASE)
+                val = re.compile(process_value(arg,param), re.IGNORECASE)
                 query_ret.append({arg: val})
                 continue
             if query[arg].startswith("exists="):
@@ -408,19 +459,42 @@ class NetworkResourceHandler(SSEHandler):
                 continue
             split_or = query[arg].split("|")
             if len(split_or) > 1:
-                query_ret.append((await process_or_query(arg, split_or)))
+                query_ret.append(process_or_query(arg, split_or))
                 continue
             split = query[arg].split(",")
             if len(split) > 1:
-                in_q = await process_in_query(arg, split)
+                in_q = process_in_query(arg, split)
                 query_ret.append(in_q)
             else:
-                query_ret.append({arg: await process_value(arg, split[0])})
+                query_ret.append({arg: process_value(arg, split[0])})
         if query_ret:
             query_ret = {"list": True, "query": {"$and": query_ret}}
         else:
             query_ret = {"list": False, "query": {}}
 
+        plan.update({"fields": fields, "limit": limit, "query": query_ret, "skip": skip,
+                     "sort": sort , "cert": cert, "inline": inline, "unique": unique,
+                     "exact_count": exact_count, "compact": compact, "bsonseq": bsonseq})
+        return plan
+
+    async def _bind_get_arguments(self, plan):
+        """Binds a compiled query plan to the current request."""
+        async def resolve(value):
+            if isinstance(value, _RecFind):
+                return {"$in": await self.dblayer.getRecParentNames(value.parent, {})}
+            elif isinstance(value, dict):
+                return {k: await resolve(v) for k,v in value.items()}
+            elif isinstance(value, list):
+                return [await resolve(v) for v in value]
+            return value
+
+        # Plans are shared between requests, copy anything the caller may modify
+        query_ret = {"list": plan["query"]["list"], "query": dict(plan["query"]["query"])}
+        if plan["recfind"]:
+            query_ret["query"] = await resolve(query_ret["query"])
+        elif query_ret["list"]:
+            query_ret["query"]["$and"] = list(query_ret["query"]["$and"])
+
         # do any PPI query updates if there was an original query
         if getattr(self.application, '_ppi_classes', None):
             for pp in self.application._ppi_classes:
@@ -430,11 +504,10 @@ class NetworkResourceHandler(SSEHandler):
                     for item in query_ret["query"]["$and"]:
                         ret.append(item)
                 query_ret["query"].update({"$and": ret})
-        ret_val = {"fields": fields, "limit": limit, "query": query_ret, "skip": skip,
-                   "sort": sort , "cert": cert, "inline": inline, "unique": unique}
+        ret_val = {k: v for k,v in plan.items() if k != "recfind"}
+        ret_val.update({"fields": dict(plan["fields"]), "sort": list(plan["sort"]), "query": query_ret})
         return ret_val
 
-    
     # Template Method for GET
     async def get(self, res_id = None, *args):
         super(NetworkResourceHandler, self).get(*args)
@@ -470,7 +543,7 @@ class NetworkResourceHandler(SSEHandler):
             self._get_tailable(query = options["query"], fields = options["fields"])
         else:
             try:
-                count, cursor = await self._find(**options)
+                count, cursor = await self._find(exact_count=parsed["exact_count"], **options)
             except Exception as exp:
                 message = "Could not find resource - {exp}".format(exp = exp)
                 self.send_error(404, message = message)
@@ -478,7 +551,8 @@ class NetworkResourceHandler(SSEHandler):
                 return
             
             try:
-                await self._write_get(cursor, is_list or count > 1, inline, parsed['unique'], count)
+                count = await self._write_get(cursor, is_list, inline, parsed['unique'], count,
+                                              compact=parsed['compact'], bsonseq=parsed['bsonseq'])
             except DBError:
                 self.send_error(404, message="No resources match query.")
                 self.log.error("No resources match query.")
@@ -489,56 +563,164 @@ class NetworkResourceHandler(SSEHandler):
                 self.log.error(message)
                 return
 
-            await self._add_response_headers(count)
-
-            self.set_status(200)
+            if self._client_closed:
+                return
+            if not self._flushed:
+                await self._add_response_headers(count)
+                self.set_status(200)
             self.finish()
             
-    async def _find(self, **kwargs):
-        return await self.dblayer.count(**kwargs), self.dblayer.find(**kwargs)
+    async def _find(self, exact_count=False, **kwargs):
+        """
+        Returns the count and cursor for a query.  The count is only
+        queried from the database when ``exact_count`` is set, otherwise
+        it is None and the records are counted while they are written.
+        """
+        count = await self.dblayer.count(**kwargs) if exact_count else None
+        return count, self.dblayer.find(**kwargs)
     
     async def _add_response_headers(self, count):
         accept = self.accept_content_type
         self.set_header("Content-Type", accept + "; profile=" + self.schemas_single[accept])
         
-        self.set_header('X-Count', count)
+        if count is not None:
+            self.set_header('X-Count', count)
 
         return count
+
+    def on_connection_close(self):
+        self._client_closed = True
+        super(NetworkResourceHandler, self).on_connection_close()
+
+    async def _stream(self, data, count=None, final=False):
+        """
+        Buffers rendered output and writes it to the response in chunks of
+        stream.chunksize pieces.  Once stream.highwater bytes are pending,
+        the response is flushed with chunked transfer encoding and waits for
+        the client to drain it.
+
+        Headers go out with the first flush, so X-Count is only sent on a
+        flushed response when count is already known.  Returns False when
+        the client has disconnected and the response should be abandoned.
+        """
+        if self._client_closed:
+            return False
+        options = self.application.options["stream"]
+        if data:
+            self._chunk.append(data)
+            self._chunk_size += len(data)
+        if self._chunk and (final or len(self._chunk) >= int(options["chunksize"])):
+            join = b"".join if isinstance(self._chunk[0], bytes) else "".join
+            self.write(join(self._chunk))
+            self._pending += self._chunk_size
+            self._chunk, self._chunk_size = [], 0
+        if not final and self._pending >= int(options["highwater"]):
+            if not self._flushed:
+                await self._add_response_headers(count)
+                self._flushed = True
+            try:
+                await self.flush()
+            except StreamClosedError:
+                self._client_closed = True
+            self._pending = 0
+        return not self._client_closed
     
-    async def _write_get(self, cursor, is_list=False, inline=False, unique=False, count=0):
-        results, seen = [], {}
+    async def _peek(self, cursor, n=2):
+        """
+        Reads up to ``n`` records ahead of a cursor.  Returns the records
+        read and an iterator over the full result, including the lookahead.
+        """
+        head, records = [], cursor.__aiter__()
+        try:
+            while len(head) < n:
+                head.append(await records.__anext__())
+        except StopAsyncIteration:
+            pass
+
+        async def _chain():
+            for record in head:
+                yield record
+            if len(head) == n:
+                async for record in records:
+                    yield record
+        return head, _chain()
+
+    async def _write_get(self, cursor, is_list=False, inline=False, unique=False, count=None,
+                         compact=False, bsonseq=False):
+        """
+        Writes the records from cursor to the response and returns the
+        count to report in X-Count.  When count is None, the number of
+        records written is returned instead.
 
-        if self.accept_content_type == MIME["PSBSON"]:
-            i, results = 0, {}
-            async for record in cursor:
-                record = await self._post_get(record, inline)
+        BSON responses are a single document keyed by record index, or with
+        bsonseq, a concatenated sequence of one document per record.
+        """
+        results, seen, written = [], {}, 0
+
+        if self.accept_content_type == MIME["PSBSON"] and bsonseq:
+            async for record in self._post_get_all(cursor, inline):
                 if not unique or str(record.get('id', record)) not in seen:
                     seen[str(record.get('id', record))] = True
-                    results[str(i)] = record
-                    i += 1
+                    if not await self._stream(bson_encode(record), count):
+                        return written if count is None else count
+                    written += 1
+            await self._stream(None, count, final=True)
+        elif self.accept_content_type == MIME["PSBSON"]:
+            results = {}
+            async for record in self._post_get_all(cursor, inline):
+                if not unique or str(record.get('id', record)) not in seen:
+                    seen[str(record.get('id', record))] = True
+                    results[str(written)] = record
+                    written += 1
             results = bson_encode(results)
             self.write(results)
         else:
-            if not count:
+            # Look ahead instead of counting to decide if the response is a list
+            head, cursor = await self._peek(cursor)
+            if not head:
                 self.write('[]')
-                return count
-            
+                return 0 if count is None else count
+            is_list = is_list or len(head) > 1
+
             first = True
-            if is_list: self.write('[\n')
-            async for record in cursor:
-                record = await self._post_get(record, inline)
+            if is_list: await self._stream('[\n', count)
+            async for record in self._post_get_all(cursor, inline):
                 if not unique or str(record.get('id', record)) not in seen:
-                    if not first:
-                        self.write(',\n')
-                    first = False
                     seen[str(record.get('id', record))] = True
-                    json_response = _render(record)
-                    self.write(json_response)
-            if is_list: self.write('\n]')
-        return count
+                    json_response = _render(record, compact)
+                    if not await self._stream(json_response if first else ',\n' + json_response, count):
+                        return written if count is None else count
+                    first = False
+                    written += 1
+            if is_list: await self._stream('\n]', count)
+            await self._stream(None, count, final=True)
+        return written if count is None else count
 
     async def _post_get(self, resource, inline=False):
         return resource
+
+    async def _post_get_page(self, resources, inline=False):
+        return [await self._post_get(resource, inline) for resource in resources]
+
+    async def _post_get_all(self, cursor, inline=False):
+        """
+        Yields the records of cursor after post processing.  With inline the
+        records are handed to _post_get_page a page at a time so related
+        records can be fetched together.
+        """
+        if not inline:
+            async for record in cursor:
+                yield await self._post_get(record, inline)
+            return
+        size, page = int(self.application.options["stream"]["chunksize"]), []
+        async for record in cursor:
+            page.append(record)
+            if len(page) >= size:
+                for record in await self._post_get_page(page, inline):
+                    yield record
+                page = []
+        for record in await self._post_get_page(page, inline):
+            yield record
     
     async def _get_tailable(self, query, fields):
         count, cursor = await self._find(query      = query,
@@ -589,7 +771,7 @@ class NetworkResourceHandler(SSEHandler):
         try:
             for index in range(len(resources)):
                 tmpResource = await self._process_resource(resources[index], res_id, run_validate)
-                resources[index] = dict(tmpResource._to_mongoiter())
+                resources[index] = escape_mongo(tmpResource)
         except Exception as exp:
             message="Not valid body - {exp}".format(exp = exp)
             traceback.print_tb(exp.__traceback__)
@@ -621,8 +803,7 @@ class NetworkResourceHandler(SSEHandler):
         self.finish()
 
     async def _insert(self, resources):
-        await self.dblayer.insert(resources)
-        self._subscriptions.publish(resources, self._collection_name, { "action": "POST" })
+        await insert_resources(self._spec, resources)
 
     async def _process_resource(self, resource, res_id = None, run_validate = True):
         tmpResource = self._model_class(resource)
@@ -631,15 +812,18 @@ class NetworkResourceHandler(SSEHandler):
         if run_validate == True:
             tmpResource._validate()
 
-        ppi_classes = getattr(self.application, '_ppi_classes', [])
-        for pp in ppi_classes:
-            pp.pre_post(tmpResource, self.application, self.request, Handler = self)
+        pre_post(tmpResource, self.application, self.request, self)
 
         return tmpResource
 
+    # @description: _post_return echoes the records that were written, with ?return=minimal
+    #                 only their ids and selfRefs are returned.
     async def _post_return(self, resources):
-        query = {"$or": [ { self.Id: res[self.Id], self.timestamp: res[self.timestamp] } for res in resources ] }
-        await self._return_resources(query)
+        if self.get_argument("return", None) == "minimal":
+            response = [{ self.Id: res[self.Id], "selfRef": res.get("selfRef", None) } for res in resources]
+        else:
+            response = [{ k: v for k,v in res.items() if k != "_id" } for res in resources]
+        self._write_resources(response)
 
     # Template Method for PUT
     @tornado.web.removeslash
@@ -699,7 +883,7 @@ class NetworkResourceHandler(SSEHandler):
             publish.update(resource)
             publish["$schema"] = resource.get("$schema", self.schemas_single[MIME['PSJSON']])
             query = { self.Id: resource[self.Id] }
-            await self._update(query, dict(resource._to_mongoiter()))
+            await self._update(query, escape_mongo(resource))
             self._subscriptions.publish(publish, self._collection_name, { "action": "PUT" })
         except Exception as exp:
             raise exp
@@ -762,13 +946,8 @@ class NetworkResourceHandler(SSEHandler):
         return True
     
     def _add_post_metadata(self, resource):
-        uri = urlparse(self.request.full_url())
         try:
-            resource["selfRef"] = "{scheme}://{netloc}/{col}/{uid}".format(scheme=uri.scheme,
-                                                                           netloc=uri.netloc,
-                                                                           col=uri.path.split("/")[1],
-                                                                           uid = resource[self.Id])
-            resource["$schema"] = resource.get("$schema", self.schemas_single[MIME['PSJSON']])
+            post_metadata(resource, self.request.full_url(), self._spec)
         except Exception as exp:
             self.log.error("failed to match uri - {e}".format(e = exp))
         
@@ -783,21 +962,22 @@ class NetworkResourceHandler(SSEHandler):
             count, cursor = await self._find(query = query)
             response = []
             while (await cursor.fetch_next):
-                resource = ObjectDict._from_mongo(cursor.next_object())
-                response.append(resource)
-        
-            if len(response) == 1:
-                location = self.request.full_url().split('?')[0]
-                if not location.endswith(response[0][self.Id]):
-                    location = location + "/" + response[0][self.Id]
-                    
-                self.set_header("Location", location)
-                self.write(dumps_mongo(response[0], indent=2))
-            else:
-                self.write(dumps_mongo(response, indent=2))
+                response.append(cursor.next_object())
+            self._write_resources(response)
         except Exception as exp:
             raise ValueError(exp)
 
+    def _write_resources(self, response):
+        if len(response) == 1:
+            location = self.request.full_url().split('?')[0]
+            if not location.endswith(response[0][self.Id]):
+                location = location + "/" + response[0][self.Id]
+                
+            self.set_header("Location", location)
+            self.write(render_mongo(response[0], indent=2))
+        else:
+            self.write(render_mongo(response, indent=2))
+
     def _validate_psjson_profile(self):
         """
         Validates if the profile provided with the content-type is valid.
@@ -20,7 +20,8 @@ from tornado.httpclient import AsyncHTTPClient
 
 from periscope import settings
 from periscope.settings import MIME
-from periscope.models import Manifest, ObjectDict
+from periscope.db import escape_mongo, unescape_mongo
+from periscope import models
 from .networkresourcehandler import NetworkResourceHandler
 
 class RegisterHandler(NetworkResourceHandler):
@@ -34,7 +35,7 @@ class RegisterHandler(NetworkResourceHandler):
             await self.dblayer.insert(resources)
         
         for manifest in resources[0]["properties"]["summary"]:
-            manifest = ObjectDict._from_mongo(manifest)
+            manifest = unescape_mongo(manifest)
             manifest["href"] = accessPoint
             manifest["ttl"] = resources[0]["ttl"]
             manifest.pop(self.timestamp, 0)
@@ -43,7 +44,7 @@ class RegisterHandler(NetworkResourceHandler):
     async def _update_manifest(self, manifest, source):
         tmpDB = await self.application.get_db_layer(manifest["$collection"], self.Id, self.timestamp, False, 0)
         tmpManifest = await tmpDB.find_one({ "href": source })
-        mongoManifest = dict(Manifest(manifest)._to_mongoiter())
+        mongoManifest = escape_mongo(models.Manifest(manifest))
         if tmpManifest:
             await tmpDB.update({ "href": source }, mongoManifest, replace = True)
         else:
@@ -12,11 +12,16 @@
 # =============================================================================
 #!/usr/bin/env python
 
-import json
+import copy, json, time
+import tornado.escape
+import tornado.ioloop
 import tornado.websocket
 import tornado.gen
 
+from collections import OrderedDict
+
 import periscope.settings as settings
+from periscope.utils import make_json_patch
 
 class SubscriptionHandler(tornado.websocket.WebSocketHandler):
     def __init__(self, *args, **kwargs):
@@ -26,6 +31,16 @@ class SubscriptionHandler(tornado.websocket.WebSocketHandler):
         self.listening = False
         self.channels = []
         self._manager = subscriptionmanager.GetManager()
+        opts = self.application.options["websocket"]
+        self._queue = OrderedDict()
+        self._queue_size = int(opts["queuesize"])
+        self._policy = opts["policy"]
+        self._writing = False
+        self._seq = 0
+        self._stats = { "sent": 0, "dropped": 0, "coalesced": 0, "highwater": 0 }
+        self._delta_window = int(opts["deltawindow"]) / 1000
+        self._deltas, self._seen = OrderedDict(), {}
+        self._delta_timer = None
     
     async def open(self, resource_type = None, resource_id = None):
         self.log.info("New websocket connection: {ip}".format(ip = self.request.remote_ip))
@@ -35,6 +50,7 @@ class SubscriptionHandler(tornado.websocket.WebSocketHandler):
         
         query_string = self.get_argument("query", None)
         fields_string = self.get_argument("fields", None)
+        mode = self.get_argument("mode", None)
         query = {}
         fields = None
 
@@ -46,7 +62,7 @@ class SubscriptionHandler(tornado.websocket.WebSocketHandler):
             if resource_id:
                 query['id'] = resource_id
 
-            self._addSubscription(resource_type, query, fields)
+            self._addSubscription(resource_type, query, fields, mode)
         except ValueError as exp:
             self.write_message('Could not decode subscripition query: %s' % exp)
             self.log.warn('Could not decode subscription query: {exp} - {query}'.format(exp = exp, query = query_string))
@@ -63,25 +79,120 @@ class SubscriptionHandler(tornado.websocket.WebSocketHandler):
         
         query = body.get("query", {})
         fields = body.get("fields", None)
+        mode = body.get("mode", None)
         address = body.get("resourceType", "").split("/")
         resource_type = address[0]
         if len(address) == 2:
             query["id"] = address[1]
         
-        self._addSubscription(resource_type, query, fields)
+        self._addSubscription(resource_type, query, fields, mode)
+
+    # @description: deliver queues an encoded message to be sent as a text frame, msg is
+    #                 shared between clients and must not be modified.
+    # @input:       key identifies the resource the message describes.
+    def deliver(self, msg, key=None):
+        self._enqueue(msg, key, None)
+
+    # @description: deliver_delta records the latest version of a resource for a delta
+    #                 subscription.  Versions received within the delta window are sent
+    #                 as a single message holding the JSON patch against the version
+    #                 last sent to this client, or the whole resource the first time.
+    def deliver_delta(self, key, headers, data):
+        self._deltas[key] = (headers, data)
+        if not self._delta_timer:
+            self._delta_timer = tornado.ioloop.IOLoop.current().call_later(self._delta_window, self._flush_deltas)
+
+    def _flush_deltas(self):
+        self._delta_timer = None
+        pending, self._deltas = self._deltas, OrderedDict()
+        for key, (headers, data) in pending.items():
+            last = self._seen.pop(key, None)
+            if headers.get("action") == "DELETE" or last is None:
+                message = { "headers": headers, "data": data }
+            else:
+                patch = make_json_patch(last, data)
+                if not patch:
+                    self._seen[key] = last
+                    continue
+                message = { "headers": dict(headers, delta = True), "data": patch }
+            if headers.get("action") != "DELETE":
+                self._seen[key] = copy.deepcopy(data)
+            self._enqueue(tornado.escape.utf8(tornado.escape.json_encode(message)), None, key)
+
+    # @description: _enqueue adds a message to the outgoing queue.  When the queue is full
+    #                 the configured policy drops the oldest message or disconnects the
+    #                 client, with the coalesce policy a queued message for the same
+    #                 resource is replaced in place.  Dropping a delta also drops the later
+    #                 deltas queued for that resource, which were diffed against it, and
+    #                 forgets the version it described so the next update is sent whole.
+    # @input:       key identifies the resource the message describes.
+    #               seen is the delta state key for delta messages.
+    def _enqueue(self, msg, key, seen):
+        if self._policy == "coalesce" and key is not None and key in self._queue:
+            self._queue[key] = (msg, self._queue[key][1], seen)
+            self._stats["coalesced"] += 1
+            return
+
+        if len(self._queue) >= self._queue_size:
+            if self._policy == "disconnect":
+                self.log.warn("Closing slow websocket connection: {ip}".format(ip = self.request.remote_ip))
+                self._stats["dropped"] += len(self._queue)
+                self._queue.clear()
+                self.close(1008, "Subscription queue overflow")
+                return
+            _, (_, _, dropped) = self._queue.popitem(last=False)
+            self._stats["dropped"] += 1
+            if dropped is not None:
+                self._seen.pop(dropped, None)
+                stale = [k for k, (_, _, s) in self._queue.items() if s == dropped]
+                for k in stale:
+                    del self._queue[k]
+                self._stats["dropped"] += len(stale)
+
+        self._seq += 1
+        self._queue[key if self._policy == "coalesce" and key is not None else self._seq] = (msg, time.time(), seen)
+        self._stats["highwater"] = max(self._stats["highwater"], len(self._queue))
+        if not self._writing:
+            self._writing = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self._drain)
+
+    async def _drain(self):
+        try:
+            while self._queue:
+                _, (msg, _, _) = self._queue.popitem(last=False)
+                await self.write_message(msg)
+                self._stats["sent"] += 1
+        except tornado.websocket.WebSocketClosedError:
+            self._queue.clear()
+        finally:
+            self._writing = False
+
+    def metrics(self):
+        oldest = next(iter(self._queue.values()), None)
+        return dict(self._stats,
+                    remote = self.request.remote_ip,
+                    channels = len(self.channels),
+                    queued = len(self._queue),
+                    lag = time.time() - oldest[1] if oldest else 0)
 
-    def deliver(self, msg):
-        self.write_message(str(msg))
+    def get_compression_options(self):
+        opts = self.application.options["websocket"]
+        if opts["compression"]:
+            return { "compression_level": int(opts["compressionlevel"]) }
+        return None
 
     def on_close(self):
+        if self._delta_timer:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._delta_timer)
+            self._delta_timer = None
         for channel in self.channels:
             self._manager.removeChannel(channel, self)
 
     def check_origin(self, origin):
         return True
     
-    def _addSubscription(self, resource_type, query, fields):
+    def _addSubscription(self, resource_type, query, fields, mode=None):
         if resource_type:
             self.log.info("Adding subscription to websocket[{resource_type}]: {ip} - {query}".format(resource_type = resource_type, ip = self.request.remote_ip, query = query))
-            channel = self._manager.createChannel(query, resource_type, fields, self)
+            channel = self._manager.createChannel(query, resource_type, fields, self, delta = mode == "delta")
             self.channels.append(channel)
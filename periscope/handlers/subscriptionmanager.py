@@ -28,12 +28,77 @@ def GetManager():
 
     return __manager__
 
+class _CollectionIndex(object):
+    """
+    Subscriptions to a single collection.  Subscriptions with an exact-match
+    condition are bucketed by the value of that condition so that a published
+    resource only has to be tested against subscriptions it could match, the
+    remainder are scanned.
+    """
+    def __init__(self):
+        self.exact = {}
+        self.scan = set()
+
+    def add(self, query):
+        index = query["index"]
+        if index is None:
+            self.scan.add(query["channel"])
+        else:
+            path, values = index
+            buckets = self.exact.setdefault(path, {})
+            for value in values:
+                buckets.setdefault(value, set()).add(query["channel"])
+
+    def remove(self, query):
+        index = query["index"]
+        if index is None:
+            self.scan.discard(query["channel"])
+        else:
+            path, values = index
+            buckets = self.exact.get(path, {})
+            for value in values:
+                bucket = buckets.get(value, set())
+                bucket.discard(query["channel"])
+                if not bucket:
+                    buckets.pop(value, None)
+            if not buckets:
+                self.exact.pop(path, None)
+
+    def __len__(self):
+        return len(self.scan) + sum(len(b) for bs in self.exact.values() for b in bs.values())
+
+    def candidates(self, resource):
+        result = set(self.scan)
+        for path, buckets in self.exact.items():
+            try:
+                result |= buckets.get(_resolve(resource, path), set())
+            except (KeyError, TypeError):
+                pass
+        return result
+
+def _resolve(resource, path):
+    for key in path:
+        if not isinstance(resource, dict):
+            raise KeyError(key)
+        resource = resource[key]
+    return resource
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
 class SubscriptionManager(object):
     def __init__(self):
         global __manager__
         
         self.log = logging.getLogger("unis.subman")
         self.subscriptions = []
+        self._channels = {}
+        self._queries = {}
+        self._collections = {}
         
         if __manager__:
             self.log.warn("SubscriptionManager: Multiple instantiations of singleton SubscriptionManager")
@@ -43,139 +108,179 @@ class SubscriptionManager(object):
     # @input:       resource is a json object corrosponding to the resource in question.
     #               trim_function is an optional argument that overrides any previous
     #                 filter on the subscription and replaces them with a custom filter.
-    def publish(self, resources, collection = None, headers = {}, trim_function = None):
+    def publish(self, resources, collection = None, headers = None, trim_function = None):
         resources = resources if isinstance(resources, list) else [resources]
         for resource in resources:
             if "_id" in resource:
                 del resource["_id"]
             self._publish(resource, collection, headers, trim_function)
 
-    def _publish(self, resource, collection = None, headers = {}, trim_function = None):
-        def _compare(op, val1, val2):
-            try:
-                if op == "gt":
-                    return val1 > val2
-                elif op == "gte":
-                    return val1 >= val2
-                elif op == "lt":
-                    return val1 < val2
-                elif op == "lte":
-                    return val1 <= val2
-                elif op == "equal":
-                    return val1 == val2
-                elif op == "reg":
-                    return re.search(val2, val1)
-                elif op == "in":
-                    for inner_val in val2:
-                        if val1 == inner_val:
-                            return True
-                    return False
-                else:
-                    self.log.warn("Unkown operator in subscription")
-                    return False
-            except TypeError as exp:
-                self.log.warn("Invalid comparison operator in subscription - {exp}".format(exp = exp))
+    def _compare(self, op, val1, val2):
+        try:
+            if op == "gt":
+                return val1 > val2
+            elif op == "gte":
+                return val1 >= val2
+            elif op == "lt":
+                return val1 < val2
+            elif op == "lte":
+                return val1 <= val2
+            elif op == "equal":
+                return val1 == val2
+            elif op == "reg":
+                return re.search(val2, val1)
+            elif op == "in":
+                for inner_val in val2:
+                    if val1 == inner_val:
+                        return True
+                return False
+            else:
+                self.log.warn("Unkown operator in subscription")
                 return False
-            except re.error as exp:
-                self.log.warn("Invalid regex string - {exp}".format(exp = exp))
+        except TypeError as exp:
+            self.log.warn("Invalid comparison operator in subscription - {exp}".format(exp = exp))
+            return False
+        except re.error as exp:
+            self.log.warn("Invalid regex string - {exp}".format(exp = exp))
+            return False
+
+    # @description: _matches tests a resource against the conditions of a subscription.
+    def _matches(self, query, resource):
+        for path, value in query["match"]:
+            try:
+                tmpResourceValue = _resolve(resource, path)
+            except KeyError:
                 return False
             
-            return True
+            # If the value of the query condition is a dict, it contains an operation that must be
+            # evaluated.  If not, the value can be tested as-is.
+            if type(value) is dict:
+                for op, inner_val in value.items():
+                    if not self._compare(op, tmpResourceValue, inner_val):
+                        return False
+            elif tmpResourceValue != value:
+                return False
+        return True
+
+    # @description: _publish delivers a resource to every matching channel.  The message
+    #                 is encoded once for each distinct field projection and the same
+    #                 bytes are shared by all clients receiving that projection.  Delta
+    #                 subscribers are handed the projected resource to diff themselves.
+    def _publish(self, resource, collection = None, headers = None, trim_function = None):
+        index = self._collections.get(collection, None)
+        if not index:
+            return
 
-        for query in self.subscriptions:
-            is_member = True
-            tmpConditions = query["conditions"]
-            if "collection" in query and query["collection"] != collection:
+        headers = dict({ "collection": collection, "id": resource["id"] }, **(headers or {}))
+        trim = trim_function or self.trim_published_resource
+        data, messages = {}, {}
+        key = (headers["collection"], headers["id"])
+        for channel in index.candidates(resource):
+            query = self._channels.get(channel, None)
+            if not query or not query["subscribers"] or not self._matches(query, resource):
                 continue
-            
-            for key, value in tmpConditions.items():
-                tmpKeyList = key.split('.')
-                if tmpKeyList[0] not in resource:
-                    is_member = False
-                    break
-                else:
-                    tmpResourceValue = resource
-                
-                # For multipart keys, find the value associated with the full key path
-                for keyPart in tmpKeyList:
-                    if keyPart in tmpResourceValue:
-                        tmpResourceValue = tmpResourceValue[keyPart]
-                    else:
-                        is_member = False
-                        break
-                    
-                # If the value of the query condition is a dict, it contains an operation that must be
-                # evaluated.  If not, the value can be tested as-is.
-                if type(value) is dict:
-                    for op, inner_val in value.items():
-                        if not _compare(op, tmpResourceValue, inner_val):
-                            is_member = False
-                            break
-                else:
-                    if tmpResourceValue != value:
-                        is_member = False
-                        break
-                    
-                    
-            if is_member:
-                trim = trim_function or self.trim_published_resource
-                trimmed_resource = trim(resource, query["fields"])
-                headers["collection"] = headers.get("collection", collection)
-                headers["id"] = headers.get("id", resource["id"])
+            projection = tuple(query["fields"]) if query["fields"] is not None else None
+            if projection not in data:
+                data[projection] = trim(resource, query["fields"])
+            if query["clients"] and projection not in messages:
                 message = {
                     "headers": headers,
-                    "data": trimmed_resource
+                    "data": data[projection]
                 }
-                for client in query["clients"]:
-                    try:
-                        client.deliver(tornado.escape.json_encode(message))
-                    except Exception as exp:
-                        self.log.error("Publish failed - {exp}".format(exp = exp))
+                messages[projection] = tornado.escape.utf8(tornado.escape.json_encode(message))
+            for client in list(query["clients"]):
+                try:
+                    client.deliver(messages[projection], key)
+                except Exception as exp:
+                    self.log.error("Publish failed - {exp}".format(exp = exp))
+            for client in list(query["deltas"]):
+                try:
+                    client.deliver_delta(key + (projection,), headers, data[projection])
+                except Exception as exp:
+                    self.log.error("Publish failed - {exp}".format(exp = exp))
 
+    # @description: _compile splits the condition keys and selects the exact-match
+    #                 condition used to index the subscription, preferring the id.
+    def _compile(self, query):
+        query["match"] = [(tuple(key.split('.')), value) for key, value in query["conditions"].items()]
+        query["index"] = None
+        for path, value in sorted(query["match"], key=lambda m: m[0] != ("id",)):
+            if type(value) is dict and len(value) == 1:
+                op, inner_val = next(iter(value.items()))
+                if op == "equal":
+                    values = [inner_val]
+                elif op == "in" and isinstance(inner_val, list):
+                    values = inner_val
+                else:
+                    continue
+            elif type(value) is not dict:
+                values = [value]
+            else:
+                continue
+            if all(_hashable(v) for v in values):
+                query["index"] = (path, values)
+                break
 
     # @description: createChannel registers a series of conditions to a channel for later use
     #                 when publishing resources.
     # @input:       conditions is a dictionary of conditions which are matched against resources
     #                 when published.
     #               fields is an array of fields to filter for when publishing.
+    #               delta selects delivery of changes through the client's deliver_delta.
     # @output:      createChannel returns the channel that the listener should subscribe to.
-    def createChannel(self, conditions, collection, fields, client=None):
-        for query in self.subscriptions:
-            if conditions == query["conditions"] and collection == query["collection"]:
-                query["subscribers"] += 1
-                query["clients"].append(client)
-                return query["channel"]
+    def createChannel(self, conditions, collection, fields, client=None, delta=False):
+        key = (collection, json.dumps(conditions, sort_keys=True, default=str))
+        query = self._queries.get(key, None)
+        if query:
+            query["subscribers"] += 1
+            query["deltas" if delta else "clients"].append(client)
+            return query["channel"]
             
         channel = uuid.uuid4().hex
-        self.subscriptions.append({ "channel": channel,
-                                    "conditions": conditions,
-                                    "fields": fields,
-                                    "collection": collection,
-                                    "subscribers": 1,
-                                    "clients": [client] })
+        query = { "channel": channel,
+                  "conditions": conditions,
+                  "fields": fields,
+                  "collection": collection,
+                  "subscribers": 1,
+                  "clients": [] if delta else [client],
+                  "deltas": [client] if delta else [],
+                  "key": key }
+        self._compile(query)
+        self.subscriptions.append(query)
+        self._channels[channel] = query
+        self._queries[key] = query
+        self._collections.setdefault(collection, _CollectionIndex()).add(query)
         return channel
 
     # @description: removeChannel removes a channel from the availible channels
     # @input:       channel is the hex reference to the channel
     # @output:      boolean succes/failure
     def removeChannel(self, channel, client=None):
-        to_remove = None
-        
-        for query in self.subscriptions:
-            if query["channel"] == channel:
-                query["subscribers"] -= 1
-                try:
-                    query["clients"].remove(client)
-                except KeyError:
-                    pass
+        query = self._channels.get(channel, None)
+        if not query:
+            return
 
-                if query["subscribers"] == 0:
-                    to_remove = query
+        query["subscribers"] -= 1
+        for clients in (query["clients"], query["deltas"]):
+            if client in clients:
+                clients.remove(client)
+                break
 
-        if to_remove:
-            self.subscriptions.remove(to_remove)
+        if query["subscribers"] == 0:
+            self.subscriptions.remove(query)
+            del self._channels[channel]
+            del self._queries[query["key"]]
+            index = self._collections[query["collection"]]
+            index.remove(query)
+            if not len(index):
+                del self._collections[query["collection"]]
     
     
+    # @description: stats reports the delivery metrics of each connected client.
+    def stats(self):
+        clients = { id(c): c for query in self.subscriptions for c in query["clients"] + query["deltas"] }
+        return [c.metrics() for c in clients.values() if hasattr(c, "metrics")]
+
     # @description: trim_published_resource filters the resource for the requested fields.
     # @input:       resource is a json object corrosponding to the resource in question.
     #               fields are the fields to filter for.
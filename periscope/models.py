@@ -24,9 +24,13 @@ import jsonschema
 import time
 import re
 import functools
+import logging
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from periscope.db import escape_mongo, unescape_mongo
 from periscope.utils import json_schema_merge_extends
-from .settings import SCHEMA_CACHE_DIR,SCHEMAS
+from .settings import SCHEMA_CACHE_DIR,SCHEMA_BUNDLE_DIR,SCHEMA_FETCH_TIMEOUT,SCHEMAS
 from bson.objectid import ObjectId
 
 _CACHE = {}
@@ -42,7 +46,12 @@ class DeserializationException(Exception):
 
 
 class ObjectDict(dict):
-    """Extends the dict object to make it's keys accessible via obi.key."""
+    """
+    Extends the dict object to make it's keys accessible via obj.key.  Keys
+    are resolved by __getattr__ rather than by properties added to the class,
+    and nested dicts are wrapped when they are first read, whether through
+    an attribute, an item, get, items, values or pop.
+    """
     
     __special_properties_names__ = [
         "_schema_data",
@@ -50,6 +59,7 @@ class ObjectDict(dict):
         "_validate",
         "_value_converter",
         "_resolver",
+        "_validator",
         "__doc__",
     ]
     
@@ -64,59 +74,90 @@ class ObjectDict(dict):
         assert isinstance(schemas_loader, (SchemaCache, type(None))), \
             "schemas_loader is not of type Schemas or None."
         setattr(self, "_$schemas_loader", schemas_loader)
-        data = data or {}
-        super(ObjectDict, self).__init__(data)
-        if _set_attributes:
-            for key, value in data.items():
-                if not hasattr(self, key):
-                    self._add_property(key)
-                self._set_property(key, value)
-    
-    def _add_property(self, name, doc=None):
-        """Add a property to the class definition.
-        
-        name: the name of property.
-        
-        doc: documenation of the property to be read from obj.name.__doc__.
-        """
-        fget = lambda self: self._get_property(name)
-        fset = lambda self, v: self._set_property(name, v)
-        fdel = lambda self: self._del_property(name)
-        setattr(self.__class__, name, property(fget, fset, fdel, doc=doc))
+        super(ObjectDict, self).__init__(data or {})
     
     def _get_property(self, name):
-        """Returns the value of a property."""
-        return self.get(name, None)
+        """Returns the value of a property, wrapping it on first access."""
+        value = super(ObjectDict, self).get(name, None)
+        new_value = self._value_converter(value, name)
+        if new_value is not value:
+            super(ObjectDict, self).__setitem__(name, new_value)
+        return new_value
     
     def _set_property(self, name, value):
         """Set the value of a property."""
-        value = self._value_converter(value, name)
         super(ObjectDict, self).__setitem__(name, value)
         
     def _del_property(self, name):
         """Delete a propety."""
         if name in self:
             super(ObjectDict, self).__delitem__(name)
-        delattr(self.__class__, name)
+    
+    def __getattr__(self, name):
+        if name.startswith("__") or name not in self:
+            raise AttributeError(name)
+        return self._get_property(name)
     
     def __setattr__(self, name, value):
-        if name not in self.__class__.__special_properties_names__ and \
-            not name.startswith("_$"):
-                if not hasattr(self, name):
-                    self._add_property(name)
-                value = self._value_converter(value, name)
-        super(ObjectDict, self).__setattr__(name, value)
+        if name in self.__class__.__special_properties_names__ or \
+            name.startswith("_$"):
+            super(ObjectDict, self).__setattr__(name, value)
+        else:
+            self._set_property(name, value)
+    
+    def __delattr__(self, name):
+        if name in self.__class__.__special_properties_names__ or \
+            name.startswith("_$"):
+            super(ObjectDict, self).__delattr__(name)
+        else:
+            self._del_property(name)
+    
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return self._get_property(name)
     
     def __setitem__(self, name, value):
-        self.__setattr__(name, value)
+        self._set_property(name, value)
     
     def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
         self._del_property(name)
     
     def __iter__(self):
         for key in self.keys():
             yield key
     
+    def _wrap_values(self):
+        for key in self.keys():
+            self._get_property(key)
+    
+    def get(self, name, default=None):
+        return self._get_property(name) if name in self else default
+    
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self._set_property(name, default)
+        return self._get_property(name)
+    
+    def pop(self, name, *default):
+        if name in self:
+            self._get_property(name)
+        return super(ObjectDict, self).pop(name, *default)
+    
+    def items(self):
+        self._wrap_values()
+        return super(ObjectDict, self).items()
+    
+    def values(self):
+        self._wrap_values()
+        return super(ObjectDict, self).values()
+    
+    def copy(self):
+        self._wrap_values()
+        return super(ObjectDict, self).copy()
+    
     def iteritems(self):
         for key in self.keys():
             yield key, self[key]
@@ -127,42 +168,12 @@ class ObjectDict(dict):
     
     def _to_mongoiter(self):
         """Escapes mongo's special characters in the keys."""
-        for key, value in self.iteritems():
-            if isinstance(key, (str, bytes)):
-                key = key.replace(".", "$DOT$")
-                if key.startswith("$"):
-                    key = "\\" + key
-            if hasattr(value, "_to_mongoiter"):
-                value = dict(value._to_mongoiter())
-            if isinstance(value, list):
-                for index in range(len(value)):
-                    if hasattr(value[index], "_to_mongoiter"):
-                        value[index] = dict(value[index]._to_mongoiter())
-            yield key, value
+        return iter(escape_mongo(self).items())
     
     @classmethod
     def _from_mongo(cls, data, schemas_loader=None):
         assert isinstance(data, dict)
-        tmp = {}
-        for key, value in data.items():
-            if isinstance(key, (str, bytes)):
-                key = key.replace("$DOT$", ".")
-                if key.startswith("\\$"):
-                    key = key.lstrip("\\")
-            if hasattr(value, "_from_mongo"):
-                value = value._from_mongo(schemas_loader=schemas_loader)
-            elif isinstance(value, dict):
-                if "$schema" in value and schemas_loader:
-                    obj_cls = schemas_loader.get_class(value["$schema"])
-                else:
-                    obj_cls = ObjectDict
-                value = obj_cls._from_mongo(value, schemas_loader=None)
-            elif isinstance(value, list):
-                for index in range(len(value)):
-                    if isinstance(value[index], dict):
-                        value[index] = cls._from_mongo(value[index])
-            tmp[key] = value
-        return cls(tmp)
+        return cls(unescape_mongo(data))
     
     def _value_converter(self, value, name=None):
         """Make sure thay properties that have dict values are also returend
@@ -195,8 +206,6 @@ class ObjectDict(dict):
                     schemas_loader=getattr(self, "_$schemas_loader"))
             else:
                 value = cls(value)
-            if name and original_type != type(value):     
-                self._set_property(name, value)
         return value
 
 
@@ -225,6 +234,8 @@ def schemaMetaFactory(name, schema, extends=None):
             
             setattr(newtype, '_schema_data', schema)
             setattr(newtype, '_resolver', jsonschema.RefResolver(schema['id'], schema, store=_CACHE))
+            validator = jsonschema.validators.validator_for(schema)
+            setattr(newtype, '_validator', validator(schema, resolver=newtype._resolver))
             return newtype
     return SchemaMetaClass
 
@@ -250,40 +261,10 @@ class JSONSchemaModel(ObjectDict):
         assert isinstance(schemas_loader, (SchemaCache, type(None))), \
             "schemas_loader is not of type Schemas or None."
         
-        data = data or {}
-        dict.__init__(self, data)
+        dict.__init__(self, data or {})
         
         self._set_defaults = set_defaults
         setattr(self, "_$schemas_loader", schemas_loader)
-        
-        for key, value in data.items():
-            if not hasattr(self, key):
-                prop_type = self._get_property_type(key) or {}
-                doc = prop_type.get("description", None)
-                self._add_property(key, doc)
-            self._set_property(key, value)
-    
-    def _set_property(self, name, value):
-        """Set the value of a property."""
-        value = self._value_converter(value, name)
-        dict.__setitem__(self, name, value)
-    
-    def __setattr__(self, name, value):
-        if name not in self.__class__.__special_properties_names__ and \
-            not name.startswith("_$"):
-                if not hasattr(self, name):
-                    doc = None
-                    # Try to find if there is any doc in the pattern props
-                    for pattern, val in self._schema_data.get(
-                        "patternProperties", {}).items():
-                        if re.match(pattern, name):
-                            doc = val.get("description", None)
-                    self._add_property(name, doc)
-                value = self._value_converter(value, name)
-        super(JSONSchemaModel, self).__setattr__(name, value)
-    
-    def __setitem__(self, name, value):
-        self.__setattr__(name, value)
     
     def _get_property_type(self, name):
         if name in self._schema_data["properties"]:
@@ -333,14 +314,11 @@ class JSONSchemaModel(ObjectDict):
                     schemas_loader=getattr(self, "_$schemas_loader"))
             else:
                 value = cls(value)
-            
-            if prop_name and original_type != type(value):
-                self._set_property(prop_name, value)
         return value
     
     def _validate(self):
         try:
-            jsonschema.validate(self, self._schema_data, resolver=self._resolver)
+            self._validator.validate(self)
         except jsonschema.exceptions.ValidationError as exp:
             raise(Exception("Validation error from json - {e}".format(e = exp.message)))
         except jsonschema.exceptions.RefResolutionError as exp:
@@ -362,16 +340,12 @@ class SchemaCache(object):
     _CLASSES = {}
     def get(self, schema_uri):
         self.get_class(schema_uri) # force caching
-        return _CACHE.get(schema_uri, None) or requests.get(schema_uri).json()
+        return _CACHE.get(schema_uri, None) or _fetch_schema(schema_uri)
     
     def get_class(self, schema_uri, class_name=None, extends=None, raw=False, *args, **kwargs):
         key = (schema_uri, raw)
         def _make_class(class_name=None, extends=None):
-            schema = _CACHE.get(schema_uri, None) or requests.get(schema_uri).json()
-            if SCHEMA_CACHE_DIR and schema_uri not in _CACHE:
-                with open(SCHEMA_CACHE_DIR + "/" + schema['id'].replace('/', ''), 'w') as f:
-                    json.dump(schema, f)
-                
+            schema = _CACHE.get(schema_uri, None) or _fetch_schema(schema_uri)
             _CACHE[schema['id']] = schema
             class_name = class_name or str(schema.get("name", None))
             cls = JSONSchemaModel.json_model_factory(class_name, schema, extends,
@@ -386,6 +360,66 @@ def json_object_hook(json_object, schemas, default_class=None):
         cls = schemas.get_class(json_object["$schema"])
     return cls(json_object)
 
+def _load_schemas(path, store):
+    """Adds every schema file in path to store keyed by the schema id."""
+    for n in sorted(os.listdir(path)):
+        with open(os.path.join(path, n)) as f:
+            try:
+                schema = json.load(f)
+                store[schema['id']] = schema
+            except:
+                print("Skipping invalid JSON schema: {}".format(n))
+
+def _fetch_schema(schema_uri):
+    """
+    Downloads a schema and writes it to the cache directory.  Cache files are
+    named after the full schema id, so each version of a schema is kept.
+    """
+    schema = requests.get(schema_uri, timeout=SCHEMA_FETCH_TIMEOUT).json()
+    if SCHEMA_CACHE_DIR:
+        with open(SCHEMA_CACHE_DIR + "/" + schema['id'].replace('/', ''), 'w') as f:
+            json.dump(schema, f)
+    _CACHE[schema['id']] = schema
+    return schema
+
+def _schema_refs(schema):
+    """Yields the absolute schema uris referenced by schema."""
+    if isinstance(schema, dict):
+        for k, v in schema.items():
+            if k == "$ref" and isinstance(v, str):
+                if urlparse(v).scheme:
+                    yield v.split('#')[0] + '#'
+            else:
+                yield from _schema_refs(v)
+    elif isinstance(schema, list):
+        for v in schema:
+            yield from _schema_refs(v)
+
+def preload_schemas(schema_uris):
+    """
+    Makes the schemas in schema_uris, and the schemas they reference, available
+    without blocking on the network.  Schemas that are neither bundled nor
+    cached under the same id are fetched concurrently.  Raises if one of the
+    schemas in schema_uris cannot be fetched, a referenced schema that cannot
+    be fetched fails the validations that reach it.
+    """
+    log = logging.getLogger("unis.schemas")
+    required, pending, seen, missing = set(schema_uris), set(schema_uris), set(), []
+    with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as pool:
+        while pending:
+            seen |= pending
+            fetches = { uri: pool.submit(_fetch_schema, uri) for uri in pending if uri not in _CACHE }
+            for uri, fetch in fetches.items():
+                try:
+                    _CACHE[uri] = fetch.result()
+                except Exception as exp:
+                    log.error("Could not fetch schema {} - {}".format(uri, exp))
+                    if uri in required:
+                        missing.append(uri)
+            pending = set(r for uri in pending if uri in _CACHE for r in _schema_refs(_CACHE[uri])) - seen
+    if missing:
+        raise Exception("Could not load schemas - {}".format(", ".join(sorted(missing))))
+
 try:
     os.makedirs(SCHEMA_CACHE_DIR)
 except OSError as e:
@@ -393,66 +427,87 @@ except OSError as e:
         pass
     else:
         raise e
-for n in os.listdir(SCHEMA_CACHE_DIR):
-    with open(SCHEMA_CACHE_DIR + "/" + n) as f:
-        try:
-            schema = json.load(f)
-            _CACHE[schema['id']] = schema
-        except:
-            print("Skipping invalid JSON schema: {}".format(n))
-        
+_load_schemas(SCHEMA_BUNDLE_DIR, _CACHE)
+_load_schemas(SCHEMA_CACHE_DIR, _CACHE)
+
+MODEL_SCHEMAS = ["http://json-schema.org/draft-04/schema#",
+                 "http://json-schema.org/draft-04/hyper-schema#",
+                 "http://json-schema.org/draft-04/links#"] + list(SCHEMAS.values())
+
 schemaLoader = SchemaCache()
 
-JSONSchema = schemaLoader.get_class(
-    "http://json-schema.org/draft-04/schema#", "JSONSchema")
-HyperSchema = schemaLoader.get_class(
-    "http://json-schema.org/draft-04/hyper-schema#", "HyperSchema")
-HyperLink = schemaLoader.get_class(
-    "http://json-schema.org/draft-04/links#", "HyperLink")
+_MODELS = ("JSONSchema", "HyperSchema", "HyperLink", "NetworkResourceMeta", "MetadataMeta",
+           "NetworkResource", "Metadata", "Manifest", "Node", "Link", "Port", "Path", "Service",
+           "Network", "Domain", "Topology", "Event", "Data", "Measurement", "Exnode", "Extent")
+
+def load_models():
+    """
+    Builds the model classes from the loaded schemas.  The application calls
+    this once the schemas are preloaded, other users of the models have them
+    built on first use.
+    """
+    global JSONSchema, HyperSchema, HyperLink, NetworkResourceMeta, MetadataMeta
+    global NetworkResource, Metadata, Manifest, Node, Link, Port, Path, Service
+    global Network, Domain, Topology, Event, Data, Measurement, Exnode, Extent
+    if "Extent" in globals():
+        return
+
+    JSONSchema = schemaLoader.get_class(
+        "http://json-schema.org/draft-04/schema#", "JSONSchema")
+    HyperSchema = schemaLoader.get_class(
+        "http://json-schema.org/draft-04/hyper-schema#", "HyperSchema")
+    HyperLink = schemaLoader.get_class(
+        "http://json-schema.org/draft-04/links#", "HyperLink")
+
+    # Load the basic Network Resources defined by UNIS
+    NetworkResourceMeta = schemaMetaFactory("NetworkResourceMeta", schema=schemaLoader.get(SCHEMAS["networkresource"]))
+    MetadataMeta = schemaMetaFactory("MetadataMeta", schema=schemaLoader.get(SCHEMAS["metadata"]))
 
-# Load the basic Network Resources defined by UNIS
-NetworkResourceMeta = schemaMetaFactory("NetworkResourceMeta", schema=schemaLoader.get(SCHEMAS["networkresource"]))
-MetadataMeta = schemaMetaFactory("MetadataMeta", schema=schemaLoader.get(SCHEMAS["metadata"]))
+    class NetworkResource(JSONSchemaModel, metaclass=NetworkResourceMeta):
+        __metaclass__ = NetworkResourceMeta
+        def __init__(self, data=None, set_defaults=True, schemas_loader=None,
+            auto_id=True, auto_ts=True):
+            JSONSchemaModel.__init__(self, 
+                data=data,
+                set_defaults=set_defaults,
+                schemas_loader=schemas_loader
+            )
+            if auto_id:
+                self.id = self.id or str(ObjectId())
+            if auto_ts:
+                self.ts = self.ts or int(time.time() * 1000000)
 
-class NetworkResource(JSONSchemaModel, metaclass=NetworkResourceMeta):
-    __metaclass__ = NetworkResourceMeta
-    def __init__(self, data=None, set_defaults=True, schemas_loader=None,
-        auto_id=True, auto_ts=True):
-        JSONSchemaModel.__init__(self, 
-            data=data,
-            set_defaults=set_defaults,
-            schemas_loader=schemas_loader
-        )
-        if auto_id:
-            self.id = self.id or str(ObjectId())
-        if auto_ts:
-            self.ts = self.ts or int(time.time() * 1000000)
+    class Metadata(JSONSchemaModel, metaclass=MetadataMeta):
+        __metaclass__ = MetadataMeta
+        def __init__(self, data=None, set_defaults=True, schemas_loader=None,
+            auto_id=True, auto_ts=True):
+            JSONSchemaModel.__init__(self, 
+                data=data,
+                set_defaults=set_defaults,
+                schemas_loader=schemas_loader
+            )
+            if auto_id:
+                self.id = self.id or str(ObjectId())
+            if auto_ts:
+                self.ts = self.ts or int(time.time() * 1000000)
 
-class Metadata(JSONSchemaModel, metaclass=MetadataMeta):
-    __metaclass__ = MetadataMeta
-    def __init__(self, data=None, set_defaults=True, schemas_loader=None,
-        auto_id=True, auto_ts=True):
-        JSONSchemaModel.__init__(self, 
-            data=data,
-            set_defaults=set_defaults,
-            schemas_loader=schemas_loader
-        )
-        if auto_id:
-            self.id = self.id or str(ObjectId())
-        if auto_ts:
-            self.ts = self.ts or int(time.time() * 1000000)
+    Manifest = schemaLoader.get_class(SCHEMAS["manifest"], extends=NetworkResource)
+    Node = schemaLoader.get_class(SCHEMAS["node"], extends=NetworkResource)
+    Link = schemaLoader.get_class(SCHEMAS["link"], extends=NetworkResource)
+    Port = schemaLoader.get_class(SCHEMAS["port"], extends=NetworkResource)
+    Path = schemaLoader.get_class(SCHEMAS["path"], extends=NetworkResource)
+    Service = schemaLoader.get_class(SCHEMAS["service"], extends=NetworkResource)
+    Network = schemaLoader.get_class(SCHEMAS["network"], extends=Node)
+    Domain = schemaLoader.get_class(SCHEMAS["domain"], extends=NetworkResource)
+    Topology = schemaLoader.get_class(SCHEMAS["topology"], extends=NetworkResource)
+    Event = schemaLoader.get_class(SCHEMAS["datum"], extends=NetworkResource)
+    Data = schemaLoader.get_class(SCHEMAS["data"], extends=NetworkResource)
+    Measurement = schemaLoader.get_class(SCHEMAS['measurement'], extends=NetworkResource)
+    Exnode = schemaLoader.get_class(SCHEMAS['exnode'], extends=NetworkResource)
+    Extent = schemaLoader.get_class(SCHEMAS['extent'], extends=NetworkResource)
 
-Manifest = schemaLoader.get_class(SCHEMAS["manifest"], extends=NetworkResource)
-Node = schemaLoader.get_class(SCHEMAS["node"], extends=NetworkResource)
-Link = schemaLoader.get_class(SCHEMAS["link"], extends=NetworkResource)
-Port = schemaLoader.get_class(SCHEMAS["port"], extends=NetworkResource)
-Path = schemaLoader.get_class(SCHEMAS["path"], extends=NetworkResource)
-Service = schemaLoader.get_class(SCHEMAS["service"], extends=NetworkResource)
-Network = schemaLoader.get_class(SCHEMAS["network"], extends=Node)
-Domain = schemaLoader.get_class(SCHEMAS["domain"], extends=NetworkResource)
-Topology = schemaLoader.get_class(SCHEMAS["topology"], extends=NetworkResource)
-Event = schemaLoader.get_class(SCHEMAS["datum"], extends=NetworkResource)
-Data = schemaLoader.get_class(SCHEMAS["data"], extends=NetworkResource)
-Measurement = schemaLoader.get_class(SCHEMAS['measurement'], extends=NetworkResource)
-Exnode = schemaLoader.get_class(SCHEMAS['exnode'], extends=NetworkResource)
-Extent = schemaLoader.get_class(SCHEMAS['extent'], extends=NetworkResource)
+def __getattr__(name):
+    if name in _MODELS:
+        load_models()
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
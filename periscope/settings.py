@@ -32,6 +32,8 @@ if PERISCOPE_ROOT == "$PERISCOPE_ROOT":
     PERISCOPE_ROOT = os.path.expanduser("~/.periscope")
 
 SCHEMA_CACHE_DIR = os.path.join(PERISCOPE_ROOT, ".cache")
+SCHEMA_BUNDLE_DIR = os.path.join(os.path.dirname(__file__), "schemas")
+SCHEMA_FETCH_TIMEOUT = 5
 
 GCF_PATH = "/opt/gcf/src/"
 sys.path.append(os.path.dirname(GCF_PATH))
@@ -51,6 +53,7 @@ CONFIG_TEMPLATE = [
     Argument(None, "--softstart.pollrate", 5, int, "Rate for polling in seconds during soft start"),
     Argument("-n", "--sdnotify", False, bool, "Enable notifications and watchdog for systemd integration"),
     Argument(None, "--nohistory", False, bool, "Replace existing records with new record on insert"),
+    Argument(None, "--bulk.batchsize", 1000, int, "Number of records in each bulk write when replacing records"),
     Argument(None, "--ssl.enable", SSL_ENABLED, bool, "Enable ssl connections"),
     Argument(None, "--ssl.cert", os.path.join(PERISCOPE_ROOT, "ssl/server.pem"), str, "Certificate file"),
     Argument(None, "--ssl.key", os.path.join(PERISCOPE_ROOT, "ssl/server.key"), str, "Keyfile for ssl"),
@@ -67,6 +70,15 @@ CONFIG_TEMPLATE = [
     Argument(None, "--register.paths", [], list, "Address(es) of upstream directory server(s)"),
     Argument("-C", "--register.communities", [], list, "Labels of communities data registers to"),
     Argument("-L", "--register.limitsize", 10, int, "Maximum number of records to report verbatim before aggregation"),
+    Argument(None, "--register.threshold", 1000, int, "Number of writes summarized in memory before the manifest is stored early"),
+    Argument(None, "--querycache.size", 512, int, "Number of compiled GET query plans to cache, 0 disables the cache"),
+    Argument(None, "--stream.chunksize", 100, int, "Number of records gathered into each write of a GET response"),
+    Argument(None, "--stream.highwater", 1048576, int, "Bytes of a GET response buffered before flushing to the client"),
+    Argument(None, "--websocket.compression", False, bool, "Negotiate permessage-deflate compression for subscriptions"),
+    Argument(None, "--websocket.compressionlevel", 6, int, "Zlib compression level used for subscription messages"),
+    Argument(None, "--websocket.queuesize", 1000, int, "Number of messages queued for each subscriber before the policy applies"),
+    Argument(None, "--websocket.deltawindow", 250, int, "Milliseconds updates to a resource are coalesced for delta subscribers"),
+    Argument(None, "--websocket.policy", "oldest", str, "Policy for full subscriber queues [oldest|coalesce|disconnect]"),
 ]
 
 ######################################################################
@@ -12,12 +12,61 @@
 # =============================================================================
 import copy
 import json
+from collections import OrderedDict
 import urllib3.request
 import jsonschema
 import sys
 
 class DBError(Exception): pass
 
+class BulkInsertError(DBError):
+    """Raised when some items of a bulk write fail, errors holds
+    (index, message) pairs for each failed item."""
+    def __init__(self, errors):
+        self.errors = errors
+        msg = "; ".join("[{}] {}".format(i, m) for i,m in errors)
+        super(BulkInsertError, self).__init__("Failed to write {} item(s) - {}".format(len(errors), msg))
+
+class LRUCache(object):
+    """
+    Bounded mapping that evicts the least recently used entry once
+    full.  Lookups through get are counted as hits or misses.
+    """
+    def __init__(self, size=512):
+        self.size = size
+        self.hits, self.misses = 0, 0
+        self._v = OrderedDict()
+
+    def get(self, k, default=None):
+        try:
+            v = self._v[k]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._v.move_to_end(k)
+        self.hits += 1
+        return v
+
+    def __setitem__(self, k, v):
+        if not self.size:
+            return
+        self._v[k] = v
+        self._v.move_to_end(k)
+        while len(self._v) > self.size:
+            self._v.popitem(last=False)
+
+    def __contains__(self, k):
+        return k in self._v
+
+    def __len__(self):
+        return len(self._v)
+
+    def clear(self):
+        self._v.clear()
+
+    def stats(self):
+        return { "hits": self.hits, "misses": self.misses, "size": len(self._v) }
+
 def load_json_url(url, cache=None):
     """
     Loads a URL, if the url is already in cache it will load the cached 
@@ -110,3 +159,27 @@ def class_fullname(obj):
     """Returns the full class name of an object"""
     return obj.__module__ + "." + obj.__class__.__name__
     
+
+def make_json_patch(old, new, path=""):
+    """
+    Returns the list of JSON patch (RFC 6902) operations transforming
+    old into new.  Objects are compared key by key, any other changed
+    value, including lists, is replaced whole.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for k in old:
+            if k not in new:
+                ops.append({ "op": "remove", "path": _pointer(path, k) })
+        for k, v in new.items():
+            if k not in old:
+                ops.append({ "op": "add", "path": _pointer(path, k), "value": v })
+            else:
+                ops.extend(make_json_patch(old[k], v, _pointer(path, k)))
+        return ops
+    if type(old) is not type(new) or old != new:
+        return [{ "op": "replace", "path": path, "value": new }]
+    return []
+
+def _pointer(path, key):
+    return path + "/" + str(key).replace("~", "~0").replace("/", "~1")
@@ -0,0 +1,79 @@
+# =============================================================================
+#  periscope-ps (unis)
+#
+#  Copyright (c) 2012-2016, Trustees of Indiana University,
+#  All rights reserved.
+#
+#  This software may be modified and distributed under the terms of the BSD
+#  license.  See the COPYING file for details.
+#
+#  This software was created at the Indiana University Center for Research in
+#  Extreme Scale Technologies (CREST).
+# =============================================================================
+"""
+Compares the filter throughput of the none engine query compiler against
+the previous per-record interpreter on a 1M record collection.
+"""
+import argparse, re, time
+
+from periscope.dblayers.none import Collection
+
+def legacy_filter(q):
+    def f(x):
+        g = lambda d,f: d[f[0]] if len(f) == 1 else g(d[f[0]], f[1:])
+        lop = { '$and': lambda q, ctx: all([r(v, ctx) for v in q]),
+                '$or': lambda q, ctx: any([r(v, ctx) for v in q]),
+                '$not': lambda q, ctx: not r(q, ctx) }
+        mop = { '$eq': lambda x,y: re.match(y,x) if isinstance(y, re.Pattern) else x == y,
+                '$ne': lambda x,y: x != y,
+                '$gt': lambda x,y: y > x,
+                '$gte': lambda x,y: y >= x,
+                '$lt': lambda x,y: y < x,
+                '$lte': lambda x,y: y <= x,
+                '$in': lambda x,y: y in x}
+        def r(q, ctx=None):
+            if not isinstance(q, dict): return mop["$eq"](ctx, q)
+            vals = []
+            for k,v in q.items():
+                try: vals.append(lop[k](v, ctx))
+                except KeyError:
+                    try: vals.append(mop[k](v, ctx))
+                    except KeyError:
+                        try:
+                            vals.append(r(v, g(x, k.split('.'))))
+                        except KeyError:
+                            return False
+            return all(vals)
+        return r(q)
+    return f
+
+QUERIES = {
+    "id equality": lambda i: { "id": "port{}".format(i) },
+    "ts range": lambda i: { "ts": { "$gte": i, "$lt": i + 1000 } },
+    "nested $in": lambda i: { "properties.site": { "$in": ["site{}".format(i % 10), "site{}".format(i % 10 + 1)] } },
+    "$or": lambda i: { "$or": [{ "name": "eth{}".format(i % 4) }, { "capacity": { "$gt": 9000000000 } }] },
+    "regex": lambda i: { "name": re.compile("eth[01]") },
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--records', type=int, default=1000000, help="Number of records in the collection")
+    parser.add_argument('-q', '--queries', type=int, default=3, help="Number of queries of each kind, differing in operands")
+    args = parser.parse_args()
+
+    col = Collection("ports")
+    records = [{ "id": "port{}".format(i), "ts": i, "name": "eth{}".format(i % 4), "capacity": (i % 10) * 1000000000,
+                 "properties": { "site": "site{}".format(i % 20) } } for i in range(args.records)]
+
+    for name, make in QUERIES.items():
+        for label, compile_filter in (("legacy", legacy_filter), ("compiled", col._filter)):
+            start, matched = time.time(), 0
+            for i in range(args.queries):
+                f = compile_filter(make(i))
+                matched += sum(1 for x in records if f(x))
+            elapsed = time.time() - start
+            print("{:<12} {:<9} {:>12,.0f} records/sec  ({} matched)".format(
+                name, label, args.records * args.queries / elapsed, matched))
+
+if __name__ == "__main__":
+    main()
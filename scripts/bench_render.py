@@ -0,0 +1,99 @@
+# =============================================================================
+#  periscope-ps (unis)
+#
+#  Copyright (c) 2012-2016, Trustees of Indiana University,
+#  All rights reserved.
+#
+#  This software may be modified and distributed under the terms of the BSD
+#  license.  See the COPYING file for details.
+#
+#  This software was created at the Indiana University Center for Research in
+#  Extreme Scale Technologies (CREST).
+# =============================================================================
+"""
+Compares the GET record renderer against the previous
+json_util.dumps + string replace implementation on a 10k node topology,
+and against a single pass encoder that unescapes keys while it writes.
+"""
+import argparse, json, timeit
+from json.encoder import encode_basestring_ascii
+from bson.json_util import default
+
+from periscope.db import dumps_mongo, render_mongo, _unescape_key
+
+def legacy_render(resource):
+    return dumps_mongo(resource, indent=2).replace('\\\\$', '$').replace('$DOT$', '.')
+
+def _stream(obj):
+    if isinstance(obj, str):
+        yield encode_basestring_ascii(obj)
+    elif obj is None or isinstance(obj, (bool, int, float)):
+        yield json.dumps(obj)
+    elif isinstance(obj, dict):
+        sep = "{"
+        for k, v in obj.items():
+            yield sep + encode_basestring_ascii(_unescape_key(k) if "$" in k else k) + ":"
+            yield from _stream(v)
+            sep = ","
+        yield "}" if sep == "," else "{}"
+    elif isinstance(obj, (list, tuple)):
+        sep = "["
+        for v in obj:
+            yield sep
+            yield from _stream(v)
+            sep = ","
+        yield "]" if sep == "," else "[]"
+    else:
+        yield from _stream(default(obj))
+
+def stream_render(resource):
+    return "".join(_stream(resource))
+
+def make_topology(n):
+    host = "http://localhost:8888"
+    nodes = []
+    for i in range(n):
+        nodes.append({
+            "\\$schema": "http://unis.crest.iu.edu/schema/20160630/node#",
+            "id": "node{}".format(i),
+            "ts": 1500000000000000 + i,
+            "selfRef": "{}/nodes/node{}".format(host, i),
+            "name": "node{}".format(i),
+            "description": "benchmark node",
+            "properties": { "geni$DOThostname": "node{}.example.org".format(i), "cpus": 8, "load": 0.25 },
+            "ports": [{ "href": "{}/ports/port{}-{}".format(host, i, p), "rel": "full" } for p in range(4)],
+        })
+    return {
+        "\\$schema": "http://unis.crest.iu.edu/schema/20160630/topology#",
+        "id": "topology", "ts": 1500000000000000,
+        "selfRef": "{}/topologies/topology".format(host),
+        "nodes": nodes,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nodes', type=int, default=10000, help="Number of nodes in the topology")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="Number of timed runs, the best is reported")
+    args = parser.parse_args()
+
+    topology = make_topology(args.nodes)
+    nodes = topology["nodes"]
+    assert json.loads(legacy_render(topology)) == json.loads(render_mongo(topology, indent=2))
+    assert json.loads(stream_render(topology)) == json.loads(render_mongo(topology))
+
+    cases = [
+        ("legacy _render, per node", lambda: [legacy_render(n) for n in nodes]),
+        ("render_mongo,   per node", lambda: [render_mongo(n, indent=2) for n in nodes]),
+        ("render_mongo,   per node, compact", lambda: [render_mongo(n) for n in nodes]),
+        ("single pass,    per node, compact", lambda: [stream_render(n) for n in nodes]),
+        ("legacy _render, topology", lambda: legacy_render(topology)),
+        ("render_mongo,   topology", lambda: render_mongo(topology, indent=2)),
+        ("render_mongo,   topology, compact", lambda: render_mongo(topology)),
+        ("single pass,    topology, compact", lambda: stream_render(topology)),
+    ]
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print("{:<36} {:8.1f} ms".format(name, best * 1000))
+
+if __name__ == "__main__":
+    main()
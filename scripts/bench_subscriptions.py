@@ -0,0 +1,82 @@
+# =============================================================================
+#  periscope-ps (unis)
+#
+#  Copyright (c) 2012-2016, Trustees of Indiana University,
+#  All rights reserved.
+#
+#  This software may be modified and distributed under the terms of the BSD
+#  license.  See the COPYING file for details.
+#
+#  This software was created at the Indiana University Center for Research in
+#  Extreme Scale Technologies (CREST).
+# =============================================================================
+"""
+Compares indexed subscription matching against a linear scan of every
+subscription, publishing 1k resources to 10k active subscriptions.
+"""
+import argparse, collections, random, time
+import tornado.escape
+
+from periscope.handlers.subscriptionmanager import SubscriptionManager
+
+class Client(object):
+    def __init__(self):
+        self.delivered = collections.Counter()
+    def deliver(self, msg, key=None):
+        self.delivered[key] += 1
+
+def linear_publish(manager, resource, collection):
+    # Mirrors the previous _publish: every subscription is tested in turn
+    for query in manager.subscriptions:
+        if query["collection"] == collection and manager._matches(query, resource):
+            message = { "headers": { "collection": collection, "id": resource["id"] }, "data": resource }
+            for client in query["clients"]:
+                client.deliver(tornado.escape.json_encode(message), (collection, resource["id"]))
+
+def make_subscriptions(manager, n, resources, client):
+    for i in range(n):
+        kind = i % 100
+        if kind < 70:
+            conditions = { "id": "node{}".format(random.randrange(resources * 10)) }
+        elif kind < 99:
+            conditions = { "properties.site": "site{}".format(random.randrange(resources)) }
+        else:
+            conditions = { "ts": { "gte": random.randrange(resources) } }
+        manager.createChannel(conditions, "nodes", None, client)
+
+def make_resources(n):
+    return [{ "id": "node{}".format(i), "ts": i, "properties": { "site": "site{}".format(i) } }
+            for i in range(n)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--subscriptions', type=int, default=10000, help="Number of subscriptions")
+    parser.add_argument('-r', '--resources', type=int, default=1000, help="Number of resources published")
+    args = parser.parse_args()
+
+    # Both managers hold the same subscriptions, each with its own client
+    managers, clients = {}, {}
+    for name in ["linear", "indexed"]:
+        random.seed(0)
+        managers[name], clients[name] = SubscriptionManager(), Client()
+        make_subscriptions(managers[name], args.subscriptions, args.resources, clients[name])
+    resources = make_resources(args.resources)
+
+    start = time.perf_counter()
+    for resource in resources:
+        linear_publish(managers["linear"], resource, "nodes")
+    linear_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for resource in resources:
+        managers["indexed"]._publish(resource, "nodes", {})
+    indexed_time = time.perf_counter() - start
+
+    assert clients["indexed"].delivered == clients["linear"].delivered
+    print("{} channels, {} deliveries".format(len(managers["indexed"].subscriptions),
+                                              sum(clients["indexed"].delivered.values())))
+    for name, elapsed in [("linear scan", linear_time), ("indexed", indexed_time)]:
+        print("{:<12} {:8.1f} ms  {:10.0f} resources/s".format(name, elapsed * 1000, len(resources) / elapsed))
+
+if __name__ == "__main__":
+    main()
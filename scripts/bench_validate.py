@@ -0,0 +1,59 @@
+# =============================================================================
+#  periscope-ps (unis)
+#
+#  Copyright (c) 2012-2016, Trustees of Indiana University,
+#  All rights reserved.
+#
+#  This software may be modified and distributed under the terms of the BSD
+#  license.  See the COPYING file for details.
+#
+#  This software was created at the Indiana University Center for Research in
+#  Extreme Scale Technologies (CREST).
+# =============================================================================
+"""
+Compares validating resources with a call to jsonschema.validate against the
+validator compiled once per model class, for 10k resources of each of the
+node, port, link, metadata and extent types.
+"""
+import argparse, timeit, jsonschema
+
+from periscope import models
+from periscope.models import schemaLoader
+
+def make_resources(n):
+    Node, Port, Link, Metadata, Extent = models.Node, models.Port, models.Link, models.Metadata, models.Extent
+    host = "http://localhost:8888"
+    return [
+        (Node, [{ "id": "node{}".format(i), "name": "node{}".format(i), "ts": 1500000000000000 + i,
+                  "ports": [{ "href": "{}/ports/port{}".format(host, i), "rel": "full" }] } for i in range(n)]),
+        (Port, [{ "id": "port{}".format(i), "name": "eth{}".format(i), "ts": 1500000000000000 + i,
+                  "capacity": 10000000000, "address": { "type": "ipv4", "address": "10.0.0.1" } } for i in range(n)]),
+        (Link, [{ "id": "link{}".format(i), "ts": 1500000000000000 + i, "directed": False,
+                  "endpoints": [{ "href": "{}/ports/port{}".format(host, i), "rel": "full" },
+                                { "href": "{}/ports/port{}".format(host, i + 1), "rel": "full" }] } for i in range(n)]),
+        (Metadata, [{ "id": "md{}".format(i), "ts": 1500000000000000 + i, "eventType": "ps:tools:blipp:linux:cpu:utilization:user",
+                      "subject": { "href": "{}/nodes/node{}".format(host, i), "rel": "full" } } for i in range(n)]),
+        (Extent, [{ "id": "extent{}".format(i), "ts": 1500000000000000 + i, "offset": i * 1024, "size": 1024,
+                    "location": "ibp://depot{}:6714".format(i % 8), "lifetimes": [{ "start": "0", "end": "1" }],
+                    "parent": { "href": "{}/exnodes/ex{}".format(host, i), "rel": "full" } } for i in range(n)]),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--resources', type=int, default=10000, help="Number of resources of each type")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="Number of timed runs, the best is reported")
+    args = parser.parse_args()
+
+    models.preload_schemas(models.MODEL_SCHEMAS)
+    for cls, records in make_resources(args.resources):
+        resources = [cls(r, schemas_loader=schemaLoader) for r in records]
+        cases = [
+            ("jsonschema.validate", lambda: [jsonschema.validate(r, r._schema_data, resolver=r._resolver) for r in resources]),
+            ("compiled _validator", lambda: [r._validate() for r in resources]),
+        ]
+        for name, fn in cases:
+            best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+            print("{:<10} {:<22} {:8.1f} ms".format(cls.__name__, name, best * 1000))
+
+if __name__ == "__main__":
+    main()